@@ -4,8 +4,30 @@
 #---------------------------------------------------------------------------
 
 import unittest
-from wsutils import Pattern
-from wssolve import Letters, Cipher, Word, Solver
+import tempfile
+import json
+import math
+import asyncio
+import threading
+import time
+from contextlib import redirect_stdout, suppress
+from io import StringIO
+from pathlib import Path
+import wsutils
+from wsutils import Pattern, MemoryCatalog, BitsetCatalog, BinaryCatalog
+from wsutils import Quadgrams, globMasks, masksGlob, openCatalog
+from wsutils import maskLetters
+from wsutils import CachedCatalog, ReadOnlyCatalog, ImmutableCatalog
+from wsutils import ConnectionPool
+from wsbuild import WordList, buildRows, buildBatches, BuildTotals, isCatalog
+from wssolve import Letters, Cipher, Word, ArrayWord, Solver
+from wssolve import Profile, parsePuzzle, solveBatch, serve, openCatalogs
+from wsclient import SolverClient
+import wsbench
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 #---------------------------------------------------------------------------
 class TestPattern(unittest.TestCase):
@@ -25,6 +47,542 @@ class TestPattern(unittest.TestCase):
         p = Pattern("122_3_1_3__")
         self.assertCountEqual(p.groups(), [('1', 2), ('2', 2), ('3', 2)])
 
+#---------------------------------------------------------------------------
+WORDS = ["the", "was", "you", "dog", "and", "not", "little", "hidden",
+         "kitten", "happen", "yellow", "duck", "path", "seat", "don't"]
+
+class CatalogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpDir.name) / "words.db"
+        cat = wsutils.Catalog.create(self.path)
+        for word in WORDS:
+            cat.add(word)
+        cat.close()
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    queries = [("___", "???"), ("___", "[dty]??"), ("___", "?o?"),
+               ("1_221_", "??[dt]???"), ("__11__", "?[ai]??e?"),
+               ("___'_", "???'?"), ("____", "zzzz"), ("_", "?")]
+
+    def assertSameAsSqlite(self, cat):
+        sqlCat = wsutils.Catalog(self.path)
+        for pattern, glob in self.queries:
+            for query in (glob, globMasks(glob)):
+                self.assertEqual(cat.count(pattern, query),
+                                 sqlCat.count(pattern, glob))
+                self.assertEqual(cat.words(pattern, query),
+                                 sqlCat.words(pattern, glob))
+        sqlCat.close()
+        cat.close()
+
+class TestBulkAdd(CatalogTestCase):
+    def testSameAsAdd(self):
+        path = Path(self.tmpDir.name) / "bulk.db"
+        cat = wsutils.Catalog.create(path)
+        numRead = cat.bulkAdd(WORDS + ["the", "dog"], batchSize=4)
+        cat.close()
+        self.assertEqual(numRead, len(WORDS) + 2)
+        select = "select word, pattern from words order by rowid"
+        added = wsutils.Catalog(self.path)
+        bulk  = wsutils.Catalog(path)
+        self.assertEqual(bulk.curs.execute(select).fetchall(),
+                         added.curs.execute(select).fetchall())
+        indexes = bulk.curs.execute("select name from sqlite_master "
+                                    "where type='index'").fetchall()
+        self.assertIn(("idx_words_pattern",), indexes)
+        added.close()
+        bulk.close()
+
+class TestWordList(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpDir.name) / "words.txt"
+        self.path.write_text("The\nwas\r\nnaïve\ndon't\n\nx-ray\n" * 5 + "end")
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def testIter(self):
+        words = list(WordList(self.path))
+        self.assertEqual(words[:5], ["the", "was", "don't", "", "the"])
+        self.assertEqual(len(words), 21)
+
+    def testEntries(self):
+        path = Path(self.tmpDir.name) / "freq.txt"
+        path.write_text("the 100\nWas\t5.5\nnaïve 3\ndon't 2e3\nit\n")
+        entries = list(WordList(path).entries())
+        self.assertEqual(entries, [("the", 100.0), ("was", 5.5),
+                                   ("don't", 2000.0), ("it", 1.0)])
+
+    def testChunks(self):
+        wordList = WordList(self.path)
+        for size in (1, 7, 16, 1000):
+            words = [word for chunk in wordList.chunks(size)
+                          for word in chunk]
+            self.assertEqual(words, list(wordList))
+
+    def testBuildInParallel(self):
+        path = Path(self.tmpDir.name) / "words.db"
+        cat = wsutils.Catalog.create(path)
+        numRead = cat.bulkInsert(buildBatches([WordList(self.path)] * 2, 2))
+        self.assertEqual(numRead, 42)
+        rows = cat.curs.execute("select word from words order by rowid")
+        self.assertEqual(rows.fetchall(),
+                         [("the",), ("was",), ("don't",), ("",), ("end",)])
+        cat.close()
+
+    def testBuildTotals(self):
+        # counted by the pool or not, repeated words are only counted once
+        path = Path(self.tmpDir.name) / "words.db"
+        cat = wsutils.Catalog.create(path)
+        cat.bulkInsert(buildBatches([WordList(self.path)] * 2))
+        quadgrams = cat.buildQuadgrams()
+        cat.buildPatternStats()
+        patterns = dict(cat.curs.execute("select * from pattern_stats"))
+        cat.close()
+        for jobs in (1, 2):
+            totals = BuildTotals()
+            batches = buildBatches([WordList(self.path)] * 2, jobs,
+                                   counted=jobs > 1)
+            self.assertEqual(sum(len(rows) for rows in totals.rows(batches)),
+                             42)
+            self.assertEqual(totals.quadgrams.counts, quadgrams.counts)
+            self.assertEqual(+totals.patterns, patterns)
+
+class TestBinaryCatalog(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.binPath = Path(self.tmpDir.name) / "words.wsc"
+        numRead = BinaryCatalog.write(self.binPath,
+                                      [buildRows((word, 1.0) for word in WORDS),
+                                       buildRows([("the", 2.0)])])
+        self.assertEqual(numRead, len(WORDS) + 1)
+
+    def testSameAsSqlite(self):
+        self.assertSameAsSqlite(BinaryCatalog(self.binPath))
+
+    def testWeights(self):
+        path = Path(self.tmpDir.name) / "weights.wsc"
+        expected = {word: float(n) for n, word in enumerate(WORDS, 1)}
+        BinaryCatalog.write(path, [buildRows(expected.items())])
+        cat = BinaryCatalog(path)
+        self.assertEqual(cat.weights(reversed(WORDS)), expected)
+        self.assertEqual(cat.weights(["cat", "zebra"]),
+                         {"cat": 1.0, "zebra": 1.0})
+        cat.close()
+
+    def testOpenCatalog(self):
+        cat = openCatalog(self.binPath)
+        self.assertIsInstance(cat, BinaryCatalog)
+        cat.close()
+        cat = openCatalog(self.path)
+        self.assertIsInstance(cat, wsutils.Catalog)
+        cat.close()
+
+    def testIsCatalog(self):
+        self.assertTrue(isCatalog(self.path))
+        self.assertTrue(isCatalog(self.binPath))
+        wordsPath = Path(self.tmpDir.name) / "words.txt"
+        wordsPath.write_text("the\ncat\n")
+        self.assertFalse(isCatalog(wordsPath))
+
+class TestCatalogWeights(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.freqPath = Path(self.tmpDir.name) / "freq.db"
+        entries = [("the", 50.0), ("dog", 2.5), ("was", 7.0), ("the", 1.0)]
+        cat = wsutils.Catalog.create(self.freqPath)
+        cat.bulkAdd(entries)
+        cat.close()
+        self.binPath = Path(self.tmpDir.name) / "freq.wsc"
+        BinaryCatalog.write(self.binPath, [buildRows(entries)])
+
+    def testWeights(self):
+        expected = {"the": 50.0, "dog": 2.5, "was": 7.0, "cat": 1.0}
+        for cat in (wsutils.Catalog(self.freqPath),
+                    BinaryCatalog(self.binPath)):
+            self.assertEqual(cat.weights(["the", "dog", "was", "cat"]),
+                             expected)
+            cat.close()
+
+    def testNoWeights(self):
+        path = Path(self.tmpDir.name) / "old.db"
+        cat = wsutils.Catalog(path)
+        cat.curs.executescript("create table words (word text not null "
+                               "primary key, pattern text not null);"
+                               "insert into words values ('the', '___');")
+        self.assertEqual(cat.weights(["the"]), {"the": 1.0})
+        cat.close()
+
+class TestQuadgrams(unittest.TestCase):
+    def testAdd(self):
+        quadgrams = Quadgrams()
+        quadgrams.add("the", 2.0)
+        quadgrams.add("don't")
+        symbols = Quadgrams.encode(" the ")
+        self.assertEqual(symbols, [26, 19, 7, 4, 26])
+        self.assertEqual(quadgrams.counts[Quadgrams.index(symbols, 0)], 2.0)
+        self.assertEqual(quadgrams.counts[Quadgrams.index(symbols, 1)], 2.0)
+        self.assertEqual(sum(quadgrams.counts), 7.0)
+
+    def testScore(self):
+        quadgrams = Quadgrams()
+        quadgrams.add("the")
+        quadgrams.add("then")
+        self.assertGreater(quadgrams.score(Quadgrams.encode(" the ")),
+                           quadgrams.score(Quadgrams.encode(" teh ")))
+
+    def testStored(self):
+        tmpDir = tempfile.TemporaryDirectory()
+        path = Path(tmpDir.name) / "words.db"
+        cat = wsutils.Catalog.create(path)
+        self.assertIsNone(cat.quadgrams())
+        cat.bulkAdd([("the", 3.0), ("cat", 1.0)])
+        built = cat.buildQuadgrams()
+        self.assertEqual(cat.quadgrams().counts, built.counts)
+        cat.close()
+        binPath = Path(tmpDir.name) / "words.wsc"
+        BinaryCatalog.write(binPath, [buildRows([("the", 3.0),
+                                                 ("cat", 1.0)])])
+        cat = BinaryCatalog(binPath)
+        self.assertEqual(cat.quadgrams().counts, built.counts)
+        cat.close()
+        tmpDir.cleanup()
+
+class TestGlobMasks(unittest.TestCase):
+    def testGlobMasks(self):
+        masks = globMasks("?[ab]c'")
+        self.assertEqual(masks, (None, 0b11, 0b100, None))
+
+    def testMasksGlob(self):
+        glob = masksGlob((0x3ffffff, 0b11, 0b100, None))
+        self.assertEqual(glob, "?[ab]c?")
+
+    def testMaskCachesBounded(self):
+        # long running batch and service workers meet ever more masks
+        for cached in (wsutils.maskLetters, wsutils.maskGlob,
+                       wsutils.maskTable):
+            self.assertEqual(cached.cache_info().maxsize,
+                             wsutils.MASK_CACHE_SIZE)
+
+class TestMemoryCatalog(CatalogTestCase):
+    def testSameAsSqlite(self):
+        self.assertSameAsSqlite(MemoryCatalog(self.path))
+
+class TestBitsetCatalog(CatalogTestCase):
+    def testSameAsSqlite(self):
+        self.assertSameAsSqlite(BitsetCatalog(self.path))
+
+    def testManyLetters(self):
+        cat = BitsetCatalog(self.path)
+        allButT = 0x3ffffff & ~(1 << ord('t') - 0x61)
+        self.assertEqual(cat.words("___", (allButT, None, None)),
+                         ["was", "you", "dog", "and", "not"])
+        cat.close()
+
+class TestCatalogUpdate(CatalogTestCase):
+    def rebuilt(self, words):
+        path = Path(self.tmpDir.name) / "rebuilt.db"
+        path.unlink(missing_ok=True)
+        cat = wsutils.Catalog.create(path)
+        cat.bulkAdd(words)
+        cat.buildQuadgrams()
+        cat.buildPatternStats()
+        return cat
+
+    def assertSameAs(self, cat, rebuilt):
+        query = "select word, pattern, weight from words order by word"
+        self.assertEqual(cat.curs.execute(query).fetchall(),
+                         rebuilt.curs.execute(query).fetchall())
+        self.assertEqual(cat.quadgrams().counts, rebuilt.quadgrams().counts)
+        query = "select * from pattern_stats order by pattern"
+        self.assertEqual(cat.curs.execute(query).fetchall(),
+                         rebuilt.curs.execute(query).fetchall())
+        rebuilt.close()
+
+    def testAppend(self):
+        cat = wsutils.Catalog(self.path)
+        numRead, numAdded = cat.appendRows([buildRows([("cat", 2.0),
+                                                       ("the", 5.0),
+                                                       ("cat", 3.0)])])
+        self.assertEqual((numRead, numAdded), (3, 1))
+        self.assertSameAs(cat, self.rebuilt(WORDS + [("cat", 2.0)]))
+        self.assertEqual(cat.words("___", "c??"), ["cat"])
+        cat.close()
+
+    def testRemove(self):
+        cat = wsutils.Catalog(self.path)
+        cat.buildQuadgrams()
+        cat.buildPatternStats()
+        self.assertEqual(cat.removeWords(["the", "kitten", "zebra"]), 2)
+        self.assertSameAs(cat, self.rebuilt([word for word in WORDS
+                                             if word not in ("the",
+                                                             "kitten")]))
+        cat.close()
+
+    def testMerge(self):
+        other = self.rebuilt(["cat", "dog", "kitten", "apple"])
+        other.close()
+        cat = wsutils.Catalog(self.path)
+        cat.buildQuadgrams()
+        cat.buildPatternStats()
+        numRead, numAdded = cat.merge(Path(self.tmpDir.name) / "rebuilt.db")
+        self.assertEqual((numRead, numAdded), (4, 2))
+        merged = WORDS + ["cat", "apple"]
+        self.assertSameAs(cat, self.rebuilt(merged))
+        cat.close()
+
+    def testOldCatalog(self):
+        # a catalog from before weights, quadgrams and pattern stats
+        path = Path(self.tmpDir.name) / "old.db"
+        cat = wsutils.Catalog(path)
+        cat.curs.executescript("create table words (word text not null "
+                               "primary key, pattern text not null);"
+                               "insert into words values ('the', '___');")
+        cat.close()
+        cat = wsutils.Catalog(self.path)
+        self.assertEqual(cat.merge(path), (1, 0))
+        cat.close()
+        cat = wsutils.Catalog(path)
+        self.assertEqual(cat.appendRows([buildRows([("cat", 2.0)])]), (1, 1))
+        self.assertEqual(cat.removeWords(["the"]), 1)
+        self.assertEqual(cat.merge(self.path), (len(WORDS), len(WORDS)))
+        self.assertSameAs(cat, self.rebuilt(WORDS + [("cat", 2.0)]))
+        cat.close()
+
+    def testRollback(self):
+        cat = wsutils.Catalog(self.path)
+        def batches():
+            yield buildRows(["cat"])
+            raise ValueError("bad word list")
+        with self.assertRaises(ValueError):
+            cat.appendRows(batches())
+        self.assertEqual(cat.words("___", "c??"), [])
+        cat.close()
+
+class TestPatternStats(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        cat = wsutils.Catalog(self.path)
+        cat.buildPatternStats()
+        cat.close()
+
+    def testSameAsSqlite(self):
+        self.assertSameAsSqlite(ReadOnlyCatalog(self.path))
+
+    def testPrepareUsesStats(self):
+        cat = ReadOnlyCatalog(self.path)
+        statements = []
+        cat.curs.connection.set_trace_callback(statements.append)
+        solver = Solver(cat, "gur xvggra", "")
+        solver.prepare()
+        self.assertFalse([sql for sql in statements if "count(*)" in sql])
+        self.assertEqual([word.count for word in solver.words], [6, 4])
+        # with a known letter the guesses are counted
+        solver = Solver(cat, "gur xvggra", "g=t")
+        solver.prepare()
+        self.assertEqual([word.count for word in solver.words], [1, 1])
+        self.assertTrue([sql for sql in statements if "count(*)" in sql])
+        cat.close()
+
+    def testStaleAfterAdd(self):
+        cat = wsutils.Catalog(self.path)
+        self.assertTrue(cat.hasPatternStats)
+        cat.add("cat")
+        self.assertFalse(cat.hasPatternStats)
+        self.assertIsNone(cat.patternCount(Pattern("___")))
+        self.assertEqual(cat.count("___", "???"), 7)
+        cat.close()
+
+    def testWordNotInCatalog(self):
+        # bitten isn't in the catalog, so the letters found in the words with
+        # its pattern mustn't be taken as the only ones its letters can be
+        cat = ReadOnlyCatalog(self.path)
+        solver = Solver(cat, "gur ovggra", "")
+        solver.prepare()
+        self.assertEqual(solver.words[1].count, 4)
+        self.assertIn("b", solver.cipher["o"])
+        cat.close()
+
+class TestSolverTiers(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.smallPath = Path(self.tmpDir.name) / "small.db"
+        cat = wsutils.Catalog.create(self.smallPath)
+        for word in ["the", "little", "hidden"]:
+            cat.add(word)
+        cat.close()
+
+    def testEscalate(self):
+        small = ReadOnlyCatalog(self.smallPath)
+        big = ReadOnlyCatalog(self.path)
+        profile = Profile()
+        solver = Solver([small, big], "gur yvggyr xvggra", "",
+                        profile=profile)
+        with redirect_stdout(StringIO()):
+            solver.solve()
+        self.assertEqual(solver.decrypt(), "the little kitten")
+        self.assertEqual([solver.tiers[word] for word in solver.words],
+                         [0, 0, 1])
+        self.assertEqual(profile.counters["escalated"], 1)
+        small.close()
+        big.close()
+
+    def testFirstCatalogOnly(self):
+        small = ReadOnlyCatalog(self.smallPath)
+        solver = Solver([small], "gur yvggyr xvggra", "")
+        with redirect_stdout(StringIO()):
+            solver.solve()
+        self.assertTrue(solver.words[2].unsolvable)
+        small.close()
+
+    def testOpenLazily(self):
+        # the later catalogs are only opened if a word is looked up in them
+        for crypted, opened in (("gur yvggyr", False),
+                                ("gur yvggyr xvggra", True)):
+            cats = openCatalogs([self.smallPath, self.path], None)
+            solver = Solver(cats, crypted, "", profile=Profile())
+            with redirect_stdout(StringIO()):
+                solver.solve()
+            self.assertEqual(cats[1].opened, opened)
+            for cat in cats:
+                cat.close()
+        self.assertEqual(solver.decrypt(), "the little kitten")
+
+    def testSolveBatch(self):
+        resultsOut = StringIO()
+        with redirect_stdout(resultsOut):
+            solveBatch([self.smallPath, self.path], None,
+                       StringIO("gur yvggyr xvggra\n"))
+        self.assertEqual(json.loads(resultsOut.getvalue())["decrypted"],
+                         "the little kitten")
+
+class TestAddKnown(CatalogTestCase):
+    def testIncremental(self):
+        cat = ReadOnlyCatalog(self.path)
+        profile = Profile()
+        solver = Solver(cat, "xvggra", "", profile=profile)
+        with redirect_stdout(StringIO()):
+            solver.solve()
+            self.assertEqual(solver.words[0].count, 4)
+            numWords = profile.counters["catalog.words"]
+            self.assertTrue(solver.addKnown("x=k"))
+        self.assertEqual(solver.words[0].guesses, ["kitten"])
+        self.assertEqual(solver.decrypt(), "kitten")
+        # the guesses were filtered, not looked up again
+        self.assertEqual(profile.counters["catalog.words"], numWords)
+        cat.close()
+
+    def testContradiction(self):
+        cat = ReadOnlyCatalog(self.path)
+        profile = Profile()
+        solver = Solver(cat, "gur yvggyr", "", profile=profile)
+        with redirect_stdout(StringIO()):
+            solver.solve()
+            self.assertEqual(solver.decrypt(), "the little")
+            self.assertFalse(solver.addKnown("g=d"))
+        self.assertEqual(profile.counters["resolved"], 1)
+        self.assertEqual(str(solver.cipher["g"]), "d")
+        self.assertTrue(solver.words[1].unsolvable)
+        cat.close()
+
+    def testBeforeSolve(self):
+        cat = ReadOnlyCatalog(self.path)
+        solver = Solver(cat, "xvggra", "")
+        with redirect_stdout(StringIO()):
+            self.assertFalse(solver.addKnown("xvggra=yellow"))
+        self.assertEqual(solver.decrypt(), "yellow")
+        cat.close()
+
+class TestReadOnlyCatalog(CatalogTestCase):
+    def testSameAsSqlite(self):
+        self.assertSameAsSqlite(ReadOnlyCatalog(self.path))
+
+    def testReadOnly(self):
+        cat = ReadOnlyCatalog(self.path)
+        with self.assertRaises(wsutils.sqlite3.OperationalError):
+            cat.add("tea")
+        cat.close()
+
+    def testSeesUpdates(self):
+        # only an immutable catalog can miss changes made while it is open
+        cat = ReadOnlyCatalog(self.path)
+        self.assertEqual(cat.count("___", "te?"), 0)
+        sqlCat = wsutils.Catalog(self.path)
+        sqlCat.add("tea")
+        sqlCat.close()
+        self.assertEqual(cat.count("___", "te?"), 1)
+        cat.close()
+
+    def testImmutable(self):
+        cat = openCatalog(self.path, "sqlite-immutable")
+        self.assertIsInstance(cat, ImmutableCatalog)
+        self.assertSameAsSqlite(cat)
+        cat = openCatalog(self.path)
+        self.assertNotIsInstance(cat, ImmutableCatalog)
+        cat.close()
+
+    def testConnectionPool(self):
+        pool = ConnectionPool(self.path, size=2)
+        sqlCat = wsutils.Catalog(self.path)
+        expected = [sqlCat.words(pattern, glob)
+                    for pattern, glob in self.queries]
+        sqlCat.close()
+        results = [None] * 8
+        def query(n):
+            for repeat in range(20):
+                results[n] = [pool.words(pattern, glob)
+                              for pattern, glob in self.queries]
+        threads = [threading.Thread(target=query, args=(n,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [expected] * 8)
+        self.assertEqual(pool.count("___", "???"), 6)
+        pool.close()
+
+class TestCachedCatalog(CatalogTestCase):
+    def testSameAsSqlite(self):
+        self.assertSameAsSqlite(openCatalog(self.path, cacheSize=100))
+
+    def testHitsAndMisses(self):
+        cat = CachedCatalog(wsutils.Catalog(self.path), maxSize=2)
+        self.assertEqual(cat.count("___", "???"), 6)
+        self.assertEqual(cat.words("___", (None, None, None)),
+                         ["the", "was", "you", "dog", "and", "not"])
+        self.assertEqual(cat.count("___", "???"), 6)
+        self.assertEqual(cat.stats(), {"hits": 1, "misses": 2, "size": 1})
+        cat.words("____", "????")
+        cat.words("1_221_", "??????")
+        # the least recently used query has gone
+        cat.count("___", "???")
+        self.assertEqual(cat.stats(), {"hits": 1, "misses": 5, "size": 2})
+        cat.close()
+
+    def testPersist(self):
+        cat = openCatalog(self.path, cacheSize=10, persistCache=True)
+        cat.words("___", "t??")
+        cat.close()
+        cachePath = Path("{}.cache".format(self.path))
+        self.assertTrue(cachePath.exists())
+        cat = openCatalog(self.path, cacheSize=10, persistCache=True)
+        self.assertEqual(cat.words("___", "t??"), ["the"])
+        self.assertEqual(cat.stats(), {"hits": 1, "misses": 0, "size": 1})
+        cat.close()
+        # a rebuilt catalog doesn't use the old cache
+        cat = wsutils.Catalog(self.path)
+        cat.add("tea")
+        cat.close()
+        cat = openCatalog(self.path, cacheSize=10, persistCache=True)
+        self.assertEqual(cat.words("___", "t??"), ["the", "tea"])
+        self.assertEqual(cat.stats()["hits"], 0)
+        cat.close()
+
 #---------------------------------------------------------------------------
 class TestLetters(unittest.TestCase):
     def testEmpty(self):
@@ -189,6 +747,50 @@ class TestCipher(unittest.TestCase):
         self.assertIn("n", x['a'])
         self.assertNotIn("n", x['y'])
 
+    def testReduceAfterShrinking(self):
+        # a=h shrinks d to two letters before the {l,w} pair is checked, but
+        # the pair must still be taken from it
+        x = Cipher("buda")
+        x['b'].assign("lw")
+        x['u'].assign("lw")
+        x['d'].assign("chw")
+        x['a'].assign("h")
+        x.reduce()
+        self.assertEqual(str(x['d']), "c")
+        self.assertEqual(str(x['b']), "lw")
+
+    def testReduceCascades(self):
+        x = Cipher("abc")
+        x['a'].assign("x")
+        x['b'].assign("xy")
+        x['c'].assign("xyz")
+        reductions = x.reduce()
+        self.assertEqual(reductions, 3)
+        self.assertTrue(x.solved)
+        self.assertEqual(x.decrypt("abc"), "xyz")
+        self.assertEqual(x.reduce(), 3)
+
+    def testReduceIncrementally(self):
+        # only the letters changed since the last reduce are checked again,
+        # unless a restore has given letters back possibles
+        x = Cipher("abcd")
+        x['a'].assign("wx")
+        x['b'].assign("wxy")
+        x['c'].assign("yz")
+        x['d'].assign("wxyz")
+        start = x.snapshot()
+        self.assertEqual(x.reduce(), 0)
+        x['b'].assign("wx")
+        self.assertEqual(x.reduce(), 2)
+        self.assertEqual(x.decrypt("abcd"), "____")
+        self.assertEqual(str(x['d']), "yz")
+        x.restore(start)
+        self.assertEqual(x.reduce(), 0)
+        self.assertEqual(str(x['d']), "wxyz")
+        x['c'].assign("y")
+        self.assertEqual(x.reduce(), 3)
+        self.assertEqual(x.decrypt("abcd"), "__yz")
+
     def testDecrypt(self):
         x = Cipher("yvggyr xvggra")
         x['r'].assign("e")
@@ -197,6 +799,18 @@ class TestCipher(unittest.TestCase):
         x['x'].assign("k")
         self.assertEqual(x.decrypt("yvggyr xvggra"), "_itt_e kitte_")
 
+    def testSnapshot(self):
+        x = Cipher("yvggyr xvggra")
+        x['v'].assign("iu")
+        saved = x.snapshot()
+        x['v'].assign("i")
+        x['g'].unset("t")
+        self.assertEqual(x.slots[ord('v') - 0x61], Letters("i").bits)
+        x.restore(saved)
+        self.assertEqual(x['v'], "iu")
+        self.assertIn("t", x['g'])
+        self.assertEqual(len(x['g']), 26)
+
 #---------------------------------------------------------------------------
 class TestWord(unittest.TestCase):
     def testInit(self):
@@ -205,6 +819,25 @@ class TestWord(unittest.TestCase):
         self.assertEqual(w.pattern, Pattern("1_221_"))
         self.assertEqual(w.count, None)
 
+    def testProjections(self):
+        w = Word("xvggra")
+        w.guesses = ["kitten", "bitten", "mitten", "sitter"]
+        self.assertEqual(w.projections("gv"),
+                         {("t", "i"): ["kitten", "bitten", "mitten", "sitter"]})
+        self.assertEqual(w.projections("a"),
+                         {"n": ["kitten", "bitten", "mitten"], "r": ["sitter"]})
+        w.guesses = ["sitter"]
+        self.assertEqual(w.projections("a"), {"r": ["sitter"]})
+
+    def testFilterGuesses(self):
+        w = Word("xvggra")
+        w.guesses = ["kitten", "bitten", "mitten", "sitter"]
+        c = Cipher("xvggra")
+        self.assertIs(w.filterGuesses(c), w.guesses)
+        c['x'].assign("bms")
+        c['a'].unset("r")
+        self.assertEqual(w.filterGuesses(c), ["bitten", "mitten"])
+
     def testGlob(self):
         x = Cipher("yvggyr xvggra")
         x['v'].assign("iwauhlnq")
@@ -214,6 +847,14 @@ class TestWord(unittest.TestCase):
         g = w.glob(x)
         self.assertEqual(g, "?[ahilnquw][fiostu][fiostu]?e")
 
+    def testMasks(self):
+        x = Cipher("qba'g")
+        x['q'].assign("d")
+        x['b'].assign("ao")
+        w = Word("qba'g")
+        self.assertEqual(w.masks(x), (0b1000, 0b100000000000001, 0x3ffffff,
+                                      None, 0x3ffffff))
+
     def testSharedLetters(self):
         w1 = Word("zrng")
         w2 = Word("zbfg")
@@ -229,6 +870,22 @@ class Catalog:
         pattern = str(pattern)
         return self.data.get(pattern, [pattern]*9)
 
+class TestProfile(unittest.TestCase):
+    def testProfile(self):
+        profile = Profile()
+        for go in range(2):
+            with profile.phase("match.go", perGo=True):
+                profile.count("catalog.words")
+                profile.peak("guesses", 3 - go)
+        with profile.phase("reduce"):
+            pass
+        results = profile.asdict()
+        self.assertEqual(results["calls"], {"match.go": 2, "reduce": 1})
+        self.assertEqual(list(results["goes"]), ["match.go"])
+        self.assertEqual(results["counters"], {"catalog.words": 2})
+        self.assertEqual(results["peaks"], {"guesses": 3})
+        json.dumps(results)
+
 class TestSolverPrepare(unittest.TestCase):
     def setUp(self):
         cat = Catalog({
@@ -253,6 +910,15 @@ class TestSolverPrepare(unittest.TestCase):
         self.assertEqual(yvggyr.links, [("grv", xvggra), ("gr",  gur), ("y",   oynpx)])
         self.assertEqual(xvggra.links, [])
         self.assertEqual(oynpx.links, [("n", jnf)])
+        self.assertEqual(self.solver.roots, [yvggyr])
+
+    def testPrepareComponents(self):
+        solver = Solver(Catalog(), "gur yvggyr xvggra jnf bqq", "")
+        solver.prepare()
+        gur, yvggyr, xvggra, jnf, bqq = solver.words
+        self.assertEqual(solver.roots, [gur, jnf, bqq])
+        self.assertEqual(gur.links, [("gr", yvggyr), ("gr", xvggra)])
+        self.assertEqual(yvggyr.links, [])
 
 class TestSolverFilter(unittest.TestCase):
     def testFilterWithWords(self):
@@ -266,6 +932,17 @@ class TestSolverFilter(unittest.TestCase):
         guess = [word.guesses[0] for word in solver.words]
         self.assertEqual(guess, ["uta", "as", "mast"])
 
+    def testFilterWithWordsPropagates(self):
+        solver = Solver(Catalog(), "ab bc cd", "")
+        ab, bc, cd = solver.words
+        self.assertEqual(solver.neighbours[bc], [("b", ab), ("c", cd)])
+        ab.guesses = ["xy"]
+        bc.guesses = ["yz", "qr"]
+        cd.guesses = ["zw", "rw", "ws"]
+        numFiltered = solver._filterWithWords([ab])
+        self.assertEqual(numFiltered, 3)
+        self.assertEqual(cd.guesses, ["zw"])
+
     def testFilterGuesses(self):
         solver = Solver(Catalog(), "gur yvggyr xvggra jnf oynpx", "")
         word1 = Word("oynpx")
@@ -290,6 +967,216 @@ class TestSolverFilter(unittest.TestCase):
         guess = [word.guesses[0] for word in solver.words]
         self.assertEqual(guess, ["meat", "and", "potatoes"])
 
+@unittest.skipUnless(numpy, "NumPy is not installed")
+class TestArrayWord(unittest.TestCase):
+    def testFilterGuesses(self):
+        w = ArrayWord("xvggra")
+        w.guesses = ["kitten", "bitten", "mitten", "sitter"]
+        c = Cipher("xvggra")
+        self.assertIs(w.filterGuesses(c), w.guesses)
+        c['x'].assign("bms")
+        c['a'].unset("r")
+        self.assertEqual(w.filterGuesses(c), ["bitten", "mitten"])
+        self.assertEqual(dict(w.letterMasks())[ord('x') - 0x61],
+                         Letters("kbms").bits)
+
+    def testSameAsWord(self):
+        results = []
+        for useNumpy in (False, True):
+            solver = Solver(Catalog(), "gur yvggyr xvggra jnf oynpx", "",
+                            useNumpy)
+            guesses = [["the", "and", "was", "for"],
+                       ["little", "settle", "tattle"],
+                       ["kitten", "bitten", "sitter", "letter"],
+                       ["was", "bum", "daw", "cab", "bay"],
+                       ["black", "clunk", "plumb", "block", "clank"]]
+            for word, wordGuesses in zip(solver.words, guesses):
+                word.guesses = wordGuesses
+            with redirect_stdout(StringIO()):
+                solver.filter()
+            results.append([word.guesses for word in solver.words])
+        self.assertIsInstance(solver.words[0], ArrayWord)
+        self.assertEqual(results[0], results[1])
+
+    def testFilterWithWords(self):
+        solver = Solver(Catalog(), "edb bc abcd", "", useNumpy=True)
+        solver.words[0].guesses = ["ula", "uta", "uti"]
+        solver.words[1].guesses = ["an", "as", "is"]
+        solver.words[2].guesses = ["mast", "mint"]
+        numFiltered = solver._filterWithWords()
+        self.assertEqual(numFiltered, 5)
+        guess = [word.guesses[0] for word in solver.words]
+        self.assertEqual(guess, ["uta", "as", "mast"])
+
+class TestSolverSearch(unittest.TestCase):
+    def testSearch(self):
+        solver = Solver(Catalog(), "edb bc abcd", "")
+        solver.words[0].guesses = ["ula", "uta", "uti", "ill"]
+        solver.words[1].guesses = ["an", "as", "is", "it"]
+        solver.words[2].guesses = ["mast", "mint", "mist"]
+        solutions = [solver.decryptWith(key) for key in solver.search()]
+        self.assertCountEqual(solutions, ["uta as mast", "uti is mist"])
+
+    def testSearchKnown(self):
+        solver = Solver(Catalog(), "edb bc abcd", "e=u")
+        solver.words[0].guesses = ["uta", "ita"]
+        solver.words[1].guesses = ["as"]
+        solver.words[2].count = 0
+        solutions = [solver.decryptWith(key) for key in solver.search()]
+        self.assertEqual(solutions, ["uta as _ast"])
+
+class WeightedCatalog(Catalog):
+    def weights(self, words):
+        return {word: self.data["weights"].get(word, 1.0) for word in words}
+
+class TestSolverBest(unittest.TestCase):
+    def testBest(self):
+        cat = WeightedCatalog({"weights": {"uta": 2.0, "uti": 8.0,
+                                           "as": 4.0, "is": 2.0,
+                                           "mast": 3.0, "mist": 1.0}})
+        solver = Solver(cat, "edb bc abcd", "")
+        solver.words[0].guesses = ["ula", "uta", "uti", "ill"]
+        solver.words[1].guesses = ["an", "as", "is", "it"]
+        solver.words[2].guesses = ["mast", "mint", "mist"]
+        best = solver.best(5)
+        self.assertEqual([solver.decryptWith(key) for score, key in best],
+                         ["uta as mast", "uti is mist"])
+        self.assertAlmostEqual(best[0][0], math.log(24))
+        self.assertAlmostEqual(best[1][0], math.log(16))
+        self.assertEqual(len(solver.best(1)), 1)
+
+class TestSolverClimb(unittest.TestCase):
+    def testClimb(self):
+        quadgrams = Quadgrams()
+        for word in ["the", "cat", "sat", "on", "mat"]:
+            quadgrams.add(word)
+        solver = Solver(Catalog(), "uif dbu tbu", "the cat")
+        score, key = solver.climb(quadgrams)
+        self.assertEqual(solver.decryptWith(key), "the cat sat")
+        self.assertAlmostEqual(score, quadgrams.score(
+                                          Quadgrams.encode(" the cat sat ")))
+
+#---------------------------------------------------------------------------
+class TestSolveBatch(CatalogTestCase):
+    def testParsePuzzle(self):
+        puzzle = parsePuzzle(3, "gur qbt\tg=t\n")
+        self.assertEqual(puzzle, {"id": 3, "cryptogram": "gur qbt",
+                                  "known": "g=t"})
+        puzzle = parsePuzzle(4, '{"id": "a", "cryptogram": "gur"}')
+        self.assertEqual(puzzle, {"id": "a", "cryptogram": "gur",
+                                  "known": ""})
+
+    def testSolveBatch(self):
+        puzzlesIn = StringIO("Gur yvggyr\tt\n\n"
+                             '{"cryptogram": "abc", "known": "zzz"}\n')
+        resultsOut = StringIO()
+        with redirect_stdout(resultsOut):
+            solveBatch(self.path, None, puzzlesIn)
+        results = [json.loads(line) for line in resultsOut.getvalue().split("\n")
+                   if line]
+        self.assertEqual([result["id"] for result in results], [1, 3])
+        self.assertEqual(results[0]["decrypted"], "the little")
+        self.assertTrue(results[0]["solved"])
+        self.assertCountEqual(results[0]["timings"],
+                              ["prepare", "match", "filter"])
+        self.assertEqual(results[1]["decrypted"], "zzz")
+        self.assertNotIn("profile", results[0])
+
+    def testProfile(self):
+        puzzlesIn = StringIO("Gur yvggyr\n")
+        resultsOut = StringIO()
+        with redirect_stdout(resultsOut):
+            solveBatch(self.path, None, puzzlesIn, profile=True)
+        profile = json.loads(resultsOut.getvalue())["profile"]
+        self.assertIn("reduce", profile["phases"])
+        self.assertEqual(profile["calls"]["prepare"], 1)
+        self.assertEqual(len(profile["goes"]["match.go"]),
+                         profile["calls"]["match.go"])
+        self.assertEqual(profile["counters"]["catalog.count"], 2)
+        self.assertGreater(profile["counters"]["catalog.rows"], 0)
+        self.assertGreaterEqual(profile["peaks"]["totalGuesses"],
+                                profile["peaks"]["guesses"])
+
+class TestServe(CatalogTestCase):
+    def testServe(self):
+        address = str(Path(self.tmpDir.name) / "ws.sock")
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(serve(self.path, None, address))
+        def runServer():
+            with suppress(asyncio.CancelledError):
+                loop.run_until_complete(task)
+        thread = threading.Thread(target=runServer)
+        with redirect_stdout(StringIO()):
+            thread.start()
+            for n in range(100):
+                if Path(address).exists():
+                    break
+                time.sleep(0.05)
+            client = SolverClient(address)
+            result = client.solve("gur yvggyr", "t")
+            client.close()
+            loop.call_soon_threadsafe(task.cancel)
+            thread.join()
+        loop.close()
+        self.assertEqual(result["decrypted"], "the little")
+        self.assertFalse(Path(address).exists())
+
+#---------------------------------------------------------------------------
+class TestBench(unittest.TestCase):
+    def testDeterministic(self):
+        words = wsbench.makeWords(50, seed=3)
+        self.assertEqual(words, wsbench.makeWords(50, seed=3))
+        self.assertEqual(len({word for word, weight in words}), 50)
+        puzzles = wsbench.makePuzzles(words, 4, 2, seed=3)
+        self.assertEqual(puzzles, wsbench.makePuzzles(words, 4, 2, seed=3))
+        plain, crypted = puzzles[0]
+        self.assertEqual(len(plain.split()), 4)
+        self.assertEqual(Pattern.build(plain.replace(" ", "")),
+                         Pattern.build(crypted.replace(" ", "")))
+
+    def testKey(self):
+        key = wsbench.makeKey(seed=1)
+        self.assertEqual(sorted(key.values()), list(wsbench.LETTERS))
+        self.assertTrue(all(plain != crypt for plain, crypt in key.items()))
+        inverse = {crypt: plain for plain, crypt in key.items()}
+        self.assertEqual(wsbench.encrypt(wsbench.encrypt("it's a cat", key),
+                                         inverse), "it's a cat")
+
+    def testCompare(self):
+        baseline = {"solve": {"p50": 1.0, "p99": 1.0, "perSec": 10.0,
+                              "solvedFraction": 0.5},
+                    "build": {"wordsPerSec": 100.0}}
+        results  = {"solve": {"p50": 1.2, "p99": 9.0, "perSec": 5.0,
+                              "solvedFraction": 0.5},
+                    "build": {"wordsPerSec": 200.0}}
+        # tail percentiles are reported but not gated on
+        self.assertEqual(wsbench.compare(results, baseline, 0.25),
+                         [("solve.perSec", 10.0, 5.0)])
+        self.assertEqual(len(wsbench.compare(results, baseline, 0.1)), 2)
+
+    def testPercentiles(self):
+        self.assertNotIn("p90", wsbench.percentiles([1.0] * 5))
+        results = wsbench.percentiles([float(n) for n in range(1, 21)])
+        self.assertEqual(results["p50"], 11.0)
+        self.assertEqual(results["p90"], 19.0)
+        self.assertNotIn("p99", results)
+
+    def testTimeEach(self):
+        calls = []
+        durations = wsbench.timeEach(calls.append, ["a", "b"], repeat=3,
+                                     minSample=0)
+        self.assertEqual(len(durations), 2)
+        # one run to warm up, then the repeats
+        self.assertEqual(calls, ["a"] * 4 + ["b"] * 4)
+
+    def testTimeEachLoops(self):
+        # quick calls are timed in loops long enough to measure
+        calls = []
+        durations = wsbench.timeEach(calls.append, ["a"], repeat=3,
+                                     minSample=0.01)
+        self.assertGreater(len(calls), 100)
+        self.assertLess(durations[0], 0.001)
+
 #---------------------------------------------------------------------------
 if __name__ == "__main__":
     unittest.main()
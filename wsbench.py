@@ -0,0 +1,295 @@
+#!/usr/bin/python
+#---------------------------------------------------------------------------
+#---------------------------------------------------------------------------
+
+import sys
+import os
+import argparse
+import json
+import random
+import resource
+import subprocess
+import tempfile
+import tracemalloc
+from contextlib import closing, redirect_stdout, suppress
+from math import ceil
+from pathlib import Path
+from statistics import mean
+from time import perf_counter
+from wsutils import Pattern, globMasks, openCatalog
+from wssolve import Cipher, Solver
+
+#---------------------------------------------------------------------------
+# Everything is generated from a seed, so the same words and puzzles are
+# timed on every run.  Words are made of syllables, weighted by rank like
+# the frequencies of real words, and the puzzles are sentences of them
+# enciphered with a random key.
+CONSONANTS = "bcdfghjklmnprstvwyz"
+VOWELS     = "aeiou"
+LETTERS    = "abcdefghijklmnopqrstuvwxyz"
+
+def makeWords(n, seed=0):
+    "n distinct (word, weight) pairs, most frequent first"
+    rand = random.Random(seed)
+    words = {}
+    while len(words) < n:
+        syllables = rand.choice((1, 1, 2, 2, 2, 3, 3, 4))
+        word = "".join(rand.choice(CONSONANTS) + rand.choice(VOWELS) +
+                       rand.choice(("", "", rand.choice(CONSONANTS)))
+                       for s in range(syllables))
+        words.setdefault(word, None)
+    return [(word, round(10**6 / rank))
+            for rank, word in enumerate(words, 1)]
+
+def makeKey(seed=0):
+    "a random simple substitution key, with no letter to itself"
+    rand = random.Random(seed)
+    while True:
+        letters = list(LETTERS)
+        rand.shuffle(letters)
+        if all(plain != crypt for plain, crypt in zip(LETTERS, letters)):
+            return dict(zip(LETTERS, letters))
+
+def encrypt(text, key):
+    return "".join(key.get(letter, letter) for letter in text)
+
+def makePuzzles(words, numWords, count, seed=0):
+    "count (plaintext, cryptogram) pairs of numWords words each"
+    rand = random.Random(seed)
+    vocabulary = [word for word, weight in words]
+    weights    = [weight for word, weight in words]
+    puzzles = []
+    for n in range(count):
+        plain = " ".join(rand.choices(vocabulary, weights, k=numWords))
+        puzzles.append((plain, encrypt(plain, makeKey(rand.random()))))
+    return puzzles
+
+def writeWords(words, path):
+    with open(path, "w") as wordsOut:
+        for word, weight in words:
+            wordsOut.write("{}\t{}\n".format(word, weight))
+
+#---------------------------------------------------------------------------
+def percentiles(samples):
+    """
+    summarise latencies (in seconds).  A percentile is only given when there
+    are enough samples for it to be more than the slowest one.
+    """
+    samples = sorted(samples)
+    def at(fraction):
+        return samples[min(int(fraction * len(samples)), len(samples) - 1)]
+    results = {"mean": mean(samples), "p50": at(0.5)}
+    if len(samples) >= 20:
+        results["p90"] = at(0.9)
+    if len(samples) >= 200:
+        results["p99"] = at(0.99)
+    results["perSec"] = len(samples) / max(sum(samples), 1e-9)
+    return results
+
+REPEAT     = 5
+MIN_SAMPLE = 0.001
+
+def timeEach(func, items, repeat=REPEAT, minSample=MIN_SAMPLE):
+    """
+    the duration of func for each item, the quickest of repeat runs after
+    one to warm up, so one slow run (a GC pass, another process) is not
+    taken for a slower func
+    """
+    # a run calls func enough times to take minSample, as a single call of
+    # a few microseconds is mostly timer and scheduling noise
+    durations = []
+    for item in items:
+        tic = perf_counter()
+        func(item)
+        loops = max(1, ceil(minSample / max(perf_counter() - tic, 1e-9)))
+        best = None
+        for n in range(repeat):
+            tic = perf_counter()
+            for loop in range(loops):
+                func(item)
+            duration = (perf_counter() - tic) / loops
+            if best is None or duration < best:
+                best = duration
+        durations.append(best)
+    return durations
+
+def peakMemory(func):
+    "the most memory, in bytes, allocated while running func"
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def benchBuild(wordsPath, catalogPath, fmt, repeat=3):
+    "time building a catalog with wsbuild, as a separate process"
+    command = [sys.executable, str(Path(__file__).with_name("wsbuild.py")),
+               "--format", fmt, str(wordsPath), "-o", str(catalogPath)]
+    def build(command):
+        with suppress(FileNotFoundError):
+            Path(catalogPath).unlink()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    duration, = timeEach(build, [command], repeat)
+    with open(wordsPath) as wordsIn:
+        numWords = sum(1 for line in wordsIn)
+    # the largest of the children so far, in kilobytes on Linux
+    maxRSS = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return {"seconds": duration, "wordsPerSec": numWords / duration,
+            "peakBytes": maxRSS}
+
+def benchQueries(cat, words, count=200, seed=0):
+    "time count and words queries for the patterns of catalog words"
+    rand = random.Random(seed)
+    queries = []
+    for word, weight in rand.sample(words, min(count, len(words))):
+        # a glob that fixes about one letter in three
+        glob = "".join(letter if rand.random() < 0.3 else "?"
+                       for letter in word)
+        queries.append((Pattern.build(word), globMasks(glob)))
+    rows = sum(len(cat.words(*query)) for query in queries)
+    durations = timeEach(lambda query: cat.words(*query), queries)
+    results = {"count": percentiles(timeEach(lambda query: cat.count(*query),
+                                             queries)),
+               "words": percentiles(durations)}
+    results["words"]["rowsPerSec"] = rows / max(sum(durations), 1e-9)
+    return results
+
+def benchReduce(puzzles, seed=0):
+    "time reducing ciphers where each letter has a few possibles"
+    rand = random.Random(seed)
+    ciphers = []
+    for plain, crypted in puzzles:
+        cipher = Cipher(crypted)
+        key = dict(zip(crypted, plain))
+        for cipherLetter, possibles in cipher.items():
+            letters = {key[cipherLetter]}
+            letters.update(rand.sample(LETTERS, rand.randrange(4)))
+            possibles.assign(letters)
+        ciphers.append((cipher, cipher.snapshot()))
+    def reduce(item):
+        cipher, snapshot = item
+        cipher.restore(snapshot)
+        cipher.reduce()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        return percentiles(timeEach(reduce, ciphers))
+
+def benchSolve(cat, puzzles):
+    "time solving each puzzle, and how many come out right"
+    def solve(puzzle):
+        plain, crypted = puzzle
+        solver = Solver(cat, crypted, "")
+        solver.solve()
+        return solver.decrypt() == plain
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        results = percentiles(timeEach(solve, puzzles))
+        solved = sum(map(solve, puzzles))
+        results["solvedFraction"] = solved / len(puzzles)
+        results["peakBytes"] = peakMemory(lambda: solve(puzzles[-1]))
+    return results
+
+#---------------------------------------------------------------------------
+SIZES = {"quick": {"words": (1000, 5000), "puzzleWords": (4, 8, 16),
+                   "puzzles": 20},
+         "full":  {"words": (2000, 20000, 100000),
+                   "puzzleWords": (4, 8, 16, 32), "puzzles": 50}}
+
+def runBenchmarks(size="quick", backend=None, fmt="sqlite", seed=0):
+    sizes = SIZES[size]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpDir:
+        for numWords in sizes["words"]:
+            name = "words{}".format(numWords)
+            words = makeWords(numWords, seed)
+            wordsPath = Path(tmpDir) / (name + ".txt")
+            catalogPath = Path(tmpDir) / (name + ".cat")
+            writeWords(words, wordsPath)
+            results[name] = {"build": benchBuild(wordsPath, catalogPath, fmt)}
+            with closing(openCatalog(catalogPath, backend)) as cat:
+                results[name]["queries"] = benchQueries(cat, words, seed=seed)
+                for puzzleWords in sizes["puzzleWords"]:
+                    puzzles = makePuzzles(words, puzzleWords,
+                                          sizes["puzzles"], seed)
+                    results[name]["solve{}".format(puzzleWords)] = \
+                        benchSolve(cat, puzzles)
+                    results[name]["reduce{}".format(puzzleWords)] = \
+                        benchReduce(puzzles, seed)
+    return results
+
+def flatten(results, prefix=""):
+    "{'a': {'b': 1}} as {'a.b': 1}"
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+# the metrics that are steady enough from run to run to gate on, the means
+# and tail percentiles move with the odd slow sample
+GATED = ("p50", "seconds", "peakBytes", "PerSec", "perSec", "Fraction")
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    the (metric, baseline, result) of each gated metric that got worse by
+    more than tolerance.  Rates and fractions should go up, everything else
+    down.
+    """
+    regressions = []
+    flatResults = flatten(results)
+    for metric, before in flatten(baseline).items():
+        after = flatResults.get(metric)
+        if after is None or not before or not metric.endswith(GATED):
+            continue
+        if metric.endswith(("PerSec", "perSec", "Fraction")):
+            worse = after < before / (1 + tolerance)
+        else:
+            worse = after > before * (1 + tolerance)
+        if worse:
+            regressions.append((metric, before, after))
+    return regressions
+
+#---------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(prog="wsbench",
+                                     description="Benchmark building "
+                                                 "catalogs and solving")
+    parser.add_argument("--size", choices=SIZES, default="quick",
+                        help="how many words and puzzles (default: quick)")
+    parser.add_argument("--backend",
+                        help="how to query the catalog, as for wssolve")
+    parser.add_argument("-f", "--format", choices=("sqlite", "binary"),
+                        default="sqlite", help="the catalog format to build")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", metavar="JSON-FILE", type=Path,
+                        help="compare the results with an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="how much worse than the baseline is a "
+                             "regression (default: 0.25)")
+    parser.add_argument("-o", "--output", metavar="JSON-FILE", type=Path,
+                        help="save the results, e.g. as a new baseline")
+    args = parser.parse_args()
+    results = runBenchmarks(args.size, args.backend, args.format, args.seed)
+    for metric, value in flatten(results).items():
+        print("{:<42} {:>14.6g}".format(metric, value))
+    if args.output:
+        with open(args.output, "w") as resultsOut:
+            json.dump(results, resultsOut, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baselineIn:
+            baseline = json.load(baselineIn)
+        regressions = compare(results, baseline, args.tolerance)
+        for metric, before, after in regressions:
+            print("REGRESSION {:<31} {:>14.6g} -> {:.6g}"
+                  .format(metric, before, after))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against {}".format(args.baseline))
+
+if __name__ == "__main__":
+    main()
+
+#---------------------------------------------------------------------------
+#---------------------------------------------------------------------------
+#---------------------------------------------------------------------------
@@ -3,40 +3,256 @@
 #---------------------------------------------------------------------------
 
 import sys
+import re
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from contextlib import closing
-from wsutils import Catalog
+from collections import Counter
+from itertools import chain, islice
+from time import perf_counter
+from wsutils import Pattern, Quadgrams, Catalog, BinaryCatalog
 
 #---------------------------------------------------------------------------
 class WordList:
-    def __init__(self, path):
+    """
+    The valid words in a text file, or in the lines starting in a byte range.
+    A word may be followed by whitespace and its frequency, which becomes its
+    weight, otherwise it has a weight of 1.
+    """
+    VALID    = re.compile(r"[a-z']*")
+    WEIGHTED = re.compile(r"([a-z']*)\s+(\d+(?:\.\d*)?(?:e[-+]?\d+)?)\s*")
+
+    def __init__(self, path, start=0, end=None):
         self. path = path
+        self.start = start
+        self.end   = end
 
     def __iter__(self):
-        with self.path.open() as wordsIn:
-            for word in wordsIn:
-                word = word.replace('\n', '').lower()
-                if all('a' <= l <= 'z' or l == "'" for l in word):
-                    yield word
+        for word, weight in self.entries():
+            yield word
+
+    def entries(self):
+        "generate (word, weight) pairs"
+        valid    = self.VALID.fullmatch
+        weighted = self.WEIGHTED.fullmatch
+        with self.path.open("rb") as wordsIn:
+            for line in self._lines(wordsIn):
+                word = line.decode(errors="replace").rstrip("\r\n").lower()
+                if valid(word):
+                    yield word, 1.0
+                else:
+                    match = weighted(word)
+                    if match:
+                        yield match.group(1), float(match.group(2))
+
+    def _lines(self, wordsIn):
+        if self.start:
+            # the line that straddles start belongs to the previous chunk
+            wordsIn.seek(self.start - 1)
+            wordsIn.readline()
+        if self.end is None:
+            yield from wordsIn
+        else:
+            while wordsIn.tell() < self.end:
+                line = wordsIn.readline()
+                if not line:
+                    break
+                yield line
+
+    def chunks(self, size):
+        "split into WordLists of about size bytes each"
+        fileSize = self.path.stat().st_size
+        return [WordList(self.path, start, min(start + size, fileSize))
+                for start in range(0, fileSize, size)]
+
+def buildRows(entries):
+    if isinstance(entries, WordList):
+        entries = entries.entries()
+    return [(word, str(Pattern.build(word)), weight)
+            for word, weight in entries]
+
+def countRows(rows):
+    "rows, with the quadgram counts and pattern counts of their words"
+    quadgrams = Counter()
+    for word, pattern, weight in rows:
+        for index in Quadgrams.indices(word):
+            quadgrams[index] += weight
+    patterns = Counter(pattern for word, pattern, weight in rows)
+    return rows, quadgrams, patterns
+
+def buildCountedRows(entries):
+    return countRows(buildRows(entries))
+
+class BuildTotals:
+    """
+    The Quadgrams and pattern counts of a build's words, added up from the
+    counts of each batch as it is inserted rather than read back afterwards.
+    """
+    def __init__(self):
+        self.quadgrams = Quadgrams()
+        self.patterns  = Counter()
+        self._seen = set()
+
+    def rows(self, batches):
+        """
+        Generate the rows of each batch, adding up the counts a pool made
+        with countRows, or counting the words here for plain batches.
+        """
+        seen = self._seen
+        for batch in batches:
+            if isinstance(batch, tuple):
+                rows, quadgrams, patterns = batch
+                for word, pattern, weight in rows:
+                    if word in seen:
+                        # insert or ignore drops a repeated word, so drop
+                        # its counts too
+                        for index in Quadgrams.indices(word):
+                            quadgrams[index] -= weight
+                        patterns[pattern] -= 1
+                    else:
+                        seen.add(word)
+                self.quadgrams.addCounts(quadgrams)
+                self.patterns.update(patterns)
+            else:
+                rows = batch
+                for word, pattern, weight in rows:
+                    if word not in seen:
+                        seen.add(word)
+                        self.quadgrams.add(word, weight)
+                        self.patterns[pattern] += 1
+            yield rows
 
 #---------------------------------------------------------------------------
 def main():
-    if not len(sys.argv) in (2, 3):
-        print("usage: wsbuild TEXT-FILE [CATALOG-FILE]")
-        sys.exit(1)
-    pathIn = Path(sys.argv[1])
-    if not pathIn.is_file():
-        print("File %s not found")
-        sys.exit(1)
-    if len(sys.argv) == 3:
-        pathOut = Path(sys.argv[2])
+    parser = argparse.ArgumentParser(prog="wsbuild",
+                                     description="Build a catalog from "
+                                                 "word lists")
+    parser.add_argument("paths", metavar="TEXT-FILE", type=Path, nargs="+",
+                        help="word lists, followed by the CATALOG-FILE to "
+                             "create unless -o is given")
+    parser.add_argument("-o", "--output", metavar="CATALOG-FILE", type=Path)
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes to read word lists with")
+    parser.add_argument("-f", "--format", choices=("sqlite", "binary"),
+                        default="sqlite",
+                        help="write a SQLite catalog, or a read-only binary "
+                             "one to be memory-mapped (default: sqlite)")
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument("--append", action="store_true",
+                       help="add the words to an existing SQLite catalog")
+    modes.add_argument("--remove", action="store_true",
+                       help="remove the words listed from an existing SQLite "
+                            "catalog")
+    modes.add_argument("--merge", action="store_true",
+                       help="add the words of other SQLite catalogs, given "
+                            "instead of word lists, to an existing one")
+    args = parser.parse_args()
+    update = args.append or args.remove or args.merge
+    pathsIn = args.paths
+    if args.output:
+        pathOut = args.output
+    elif len(pathsIn) > 1:
+        pathOut = pathsIn.pop()
+        if not update and pathOut.exists() and not isCatalog(pathOut):
+            # most likely a word list, with -o left out
+            parser.error("{} is not a catalog, give the catalog to create "
+                         "with -o".format(pathOut))
+    elif update:
+        parser.error("the catalog to update must be given")
+    elif args.format == "binary":
+        pathOut = pathsIn[0].with_suffix(".wsc")
+    else:
+        pathOut = pathsIn[0].with_suffix(".db")
+    if update:
+        if args.format == "binary":
+            parser.error("a binary catalog can't be updated, build it again")
+        pathsIn.append(pathOut)
+    for pathIn in pathsIn:
+        if not pathIn.is_file():
+            print("File %s not found" % pathIn)
+            sys.exit(1)
+    if update:
+        pathsIn.pop()
+        updateCatalog(pathOut, pathsIn, args)
+        return
+
+    wordLists = [WordList(pathIn) for pathIn in pathsIn]
+    tic = perf_counter()
+    # the quadgrams and pattern counts are counted as the words are read,
+    # by the pool if there is one, instead of in passes over them after
+    totals = BuildTotals()
+    batches = totals.rows(buildBatches(wordLists, args.jobs,
+                                       counted=args.jobs > 1))
+    if args.format == "binary":
+        # totals.quadgrams is complete once write has read all the batches
+        numRead = BinaryCatalog.write(pathOut, batches, totals.quadgrams)
+        with closing(BinaryCatalog(pathOut)) as cat:
+            numAdded = sum(count for offset, count, first
+                           in cat.index.values())
     else:
-        pathOut = pathIn.with_suffix(".db")
+        with closing(Catalog.create(pathOut)) as cat:
+            # words read more than once are only inserted once
+            conn = cat.curs.connection
+            changes = conn.total_changes
+            numRead = cat.bulkInsert(batches)
+            numAdded = conn.total_changes - changes
+            cat.storeQuadgrams(totals.quadgrams)
+            cat.storePatternStats(totals.patterns)
+    duration = perf_counter() - tic
+    print("Added {} words of {} read in {:.2f}S ({:.0f} words/sec)"
+          .format(numAdded, numRead, duration,
+                  numRead / max(duration, 1e-9)))
 
-    words = WordList(pathIn)
-    with closing(Catalog.create(pathOut)) as cat:
-        for word in words:
-            cat.add(word)
+def isCatalog(path):
+    "whether path is a SQLite or binary catalog, so is safe to overwrite"
+    with open(path, "rb") as catIn:
+        header = catIn.read(16)
+    return (header == b"SQLite format 3\0" or
+            header.startswith(BinaryCatalog.MAGIC))
+
+def updateCatalog(path, pathsIn, args):
+    "append, remove or merge in the words of pathsIn, in one transaction each"
+    tic = perf_counter()
+    with closing(Catalog(path)) as cat:
+        if args.remove:
+            words = chain.from_iterable(WordList(pathIn) for pathIn in pathsIn)
+            numRemoved = cat.removeWords(words)
+            message = "Removed {} words".format(numRemoved)
+        else:
+            numRead = numAdded = 0
+            for pathIn in pathsIn:
+                if args.merge:
+                    read, added = cat.merge(pathIn)
+                else:
+                    read, added = cat.appendRows(
+                        buildBatches([WordList(pathIn)], args.jobs))
+                numRead  += read
+                numAdded += added
+            message = "Added {} new words of {}".format(numAdded, numRead)
+    print("{} in {:.2f}S".format(message, perf_counter() - tic))
+
+def buildBatches(wordLists, jobs=1, batchSize=10000, counted=False):
+    """
+    Generate batches of (word, pattern, weight) rows in file order, or if
+    counted, batches with their counts as from countRows.
+    """
+    # with jobs patterns are worked out by a pool, but only this process
+    # writes the catalog, and it does so in file order so that insert or
+    # ignore keeps the same words as a single process build
+    if jobs > 1:
+        totalSize = sum(wordList.path.stat().st_size for wordList in wordLists)
+        chunkSize = max(totalSize // (jobs * 4), 1 << 16)
+        chunks = [chunk for wordList in wordLists
+                        for chunk in wordList.chunks(chunkSize)]
+        with ProcessPoolExecutor(jobs) as pool:
+            yield from pool.map(buildCountedRows if counted else buildRows,
+                                chunks)
+    else:
+        entries = chain.from_iterable(wordList.entries()
+                                      for wordList in wordLists)
+        batches = iter(lambda: buildRows(islice(entries, batchSize)), [])
+        yield from map(countRows, batches) if counted else batches
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+#---------------------------------------------------------------------------
+#---------------------------------------------------------------------------
+
+import sys
+import argparse
+import json
+import socket
+from wsutils import parseAddress
+
+#---------------------------------------------------------------------------
+class SolverClient:
+    "A connection to a wssolve --serve solver service"
+    def __init__(self, address):
+        address = parseAddress(address)
+        if isinstance(address, tuple):
+            self.sock = socket.create_connection(address)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+        self.resultsIn = self.sock.makefile("r", encoding="utf-8")
+
+    def solve(self, cryptogram, known="", **extra):
+        puzzle = dict(extra, cryptogram=cryptogram, known=known)
+        self.sock.sendall(json.dumps(puzzle).encode() + b"\n")
+        return json.loads(self.resultsIn.readline())
+
+    def close(self):
+        self.resultsIn.close()
+        self.sock.close()
+
+#---------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(prog="wsclient",
+                                     description="Send cryptograms to a "
+                                                 "wssolve --serve service")
+    parser.add_argument("address", metavar="ADDRESS",
+                        help="[HOST:]PORT or the path of a Unix socket")
+    parser.add_argument("cryptogram", nargs="?",
+                        help="the cryptogram, if not given each line of stdin "
+                             "is sent as a puzzle")
+    parser.add_argument("known", nargs="?", default="",
+                        help="any known letters")
+    args = parser.parse_args()
+    client = SolverClient(args.address)
+    try:
+        if args.cryptogram:
+            result = client.solve(args.cryptogram, args.known)
+            print(result.get("decrypted", result.get("error")))
+        else:
+            for line in sys.stdin:
+                if line.strip():
+                    client.sock.sendall(line.rstrip("\r\n").encode() + b"\n")
+                    print(client.resultsIn.readline(), end="", flush=True)
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    main()
+
+#---------------------------------------------------------------------------
+#---------------------------------------------------------------------------
+#---------------------------------------------------------------------------
@@ -3,9 +3,20 @@
 #---------------------------------------------------------------------------
 
 import sys
+import os
+import argparse
+import asyncio
+import json
+from array import array
 from collections import deque, Counter
-from contextlib import closing, suppress
-from itertools import chain, groupby, product, zip_longest
+from heapq import heapify, heappop, heappush, heapreplace
+from math import log
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing, contextmanager, suppress, redirect_stdout
+from contextlib import ExitStack
+from functools import lru_cache, partial
+from multiprocessing.util import Finalize
+from itertools import chain, count, islice, zip_longest
 from io import StringIO
 from operator import attrgetter, itemgetter
 from pathlib import Path
@@ -13,8 +24,15 @@ from pprint import pprint
 import re
 import readline
 import atexit
-from wsutils import Pattern, Catalog
+import random
+from wsutils import Pattern, Quadgrams, BACKENDS, openCatalog
+from wsutils import maskGlob, maskLetters, maskTable, bitCount
+from wsutils import parseAddress
 from time import perf_counter_ns
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 #---------------------------------------------------------------------------
 def tictocDo(func, name, *args, **kwargs):
@@ -25,29 +43,135 @@ def tictocDo(func, name, *args, **kwargs):
     print(f"{name:<42} took {duration:>2.4f}S")
     return retval
 
+#---------------------------------------------------------------------------
+class Profile:
+    """
+    Wall times of the phases of solving, counters (of catalog queries and
+    pruned guesses) and peak sizes, to be written out as JSON
+    """
+    def __init__(self):
+        self.phases   = {}
+        self.perGo    = set()
+        self.counters = Counter()
+        self.peaks    = {}
+
+    @contextmanager
+    def phase(self, name, perGo=False):
+        if perGo:
+            self.perGo.add(name)
+        tic = perf_counter_ns()
+        try:
+            yield
+        finally:
+            toc = perf_counter_ns()
+            self.phases.setdefault(name, []).append((toc - tic) / 10**9)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def peak(self, name, value):
+        if value > self.peaks.get(name, value - 1):
+            self.peaks[name] = value
+
+    def asdict(self):
+        return {"phases":   {name: sum(durations)
+                             for name, durations in self.phases.items()},
+                "calls":    {name: len(durations)
+                             for name, durations in self.phases.items()},
+                "goes":     {name: self.phases[name] for name in self.perGo},
+                "counters": dict(self.counters),
+                "peaks":    self.peaks}
+
+class ProfilingCatalog:
+    "Count the queries made of a catalog and the rows it returns"
+    def __init__(self, catalog, profile):
+        self.catalog = catalog
+        self.profile = profile
+
+    def count(self, pattern, glob):
+        self.profile.count("catalog.count")
+        return self.catalog.count(pattern, glob)
+
+    def words(self, pattern, glob):
+        words = self.catalog.words(pattern, glob)
+        self.profile.count("catalog.words")
+        self.profile.count("catalog.rows", len(words))
+        return words
+
+    def __getattr__(self, name):
+        return getattr(self.catalog, name)
+
+class LazyCatalog:
+    "A catalog that is only opened when it is first used"
+    def __init__(self, opener):
+        self.opener  = opener
+        self.catalog = None
+
+    @property
+    def opened(self):
+        return self.catalog is not None
+
+    def __getattr__(self, name):
+        # only called for what LazyCatalog doesn't have itself
+        if self.catalog is None:
+            self.catalog = self.opener()
+        return getattr(self.catalog, name)
+
+    def close(self):
+        if self.catalog is not None:
+            self.catalog.close()
+
+def openCatalogs(paths, backend, cacheSize=0, persistCache=False):
+    """
+    open the first of the catalogs, and the others, which only some words
+    are looked up in, when they are first used
+    """
+    first, *rest = catalogPaths(paths)
+    return ([openCatalog(first, backend, cacheSize, persistCache)] +
+            [LazyCatalog(partial(openCatalog, path, backend, cacheSize,
+                                 persistCache))
+             for path in rest])
+
+def lazyQuadgrams(catalog):
+    "a function giving the catalog's Quadgrams or None, loaded when first used"
+    return lru_cache()(lambda: getattr(catalog, "quadgrams", lambda: None)())
+
 #---------------------------------------------------------------------------
 class Letters:
-    "A bitmask of possible (lowercase) letters"
+    """
+    A bitmask of possible (lowercase) letters, kept in a slot of an array so
+    that a Cipher can hold all of its letters in one
+    """
     ALL_BITS = 0x3ffffff
+    __slots__ = ("slots", "index")
 
-    def __init__(self, letters="", *, bits=0b0):
-        self.bits  = bits
+    def __init__(self, letters="", *, bits=0b0, slots=None, index=0):
+        if slots is None:
+            slots = array("L", [bits])
+        self.slots = slots
+        self.index = index
         self.set(letters)
 
+    @property
+    def bits(self):
+        return self.slots[self.index]
+
+    @bits.setter
+    def bits(self, bits):
+        self.slots[self.index] = bits
+
     @classmethod
     def all(cls):
         return cls(bits=cls.ALL_BITS)
 
     def __str__(self):
-        return "".join(self)
+        return maskLetters(self.bits)
 
     def __repr__(self):
         return "Letters('{}')".format(self)
 
     def __iter__(self):
-        for x in range(26):
-            if 1 << x & self.bits:
-                yield chr(0x61 + x)
+        return iter(maskLetters(self.bits))
 
     def __contains__(self, letters):
         v = self._bits(letters)
@@ -60,12 +184,7 @@ class Letters:
         return self.bits < self._bits(other)
 
     def __len__(self):
-        v = self.bits
-        count = 0
-        while v:
-            v &= v-1
-            count += 1
-        return count
+        return bitCount(self.bits)
 
     @property
     def solved(self):
@@ -86,13 +205,7 @@ class Letters:
         self.bits = self._bits(letters)
 
     def glob(self):
-        if self.bits == self.ALL_BITS:
-            retval = "?"
-        else:
-            retval = str(self)
-            if len(retval) > 1:
-                retval = "[{}]".format(retval)
-        return retval
+        return maskGlob(self.bits)
 
     def asbits(self):
         bit = 0b1
@@ -113,19 +226,30 @@ class Letters:
 
 #---------------------------------------------------------------------------
 class Cipher:
+    """
+    The possible plain letters for each cipher letter.  These are held in a
+    26 slot array, indexed by cipher letter, which map's Letters are views of.
+    """
     def __init__(self, crypted, decrypted="", noLetterToItself=False):
+        self.slots = array("L", [0]) * 26
         self.map = {}
+        self._reduced = None
+        self._lockedBits = set()
         processed = set()
         for cipherLetter, plainLetter in zip_longest(crypted, decrypted):
             if cipherLetter.islower() and cipherLetter not in processed:
+                letters = self.map.get(cipherLetter)
+                if letters is None:
+                    letters = Letters(slots=self.slots,
+                                      index=ord(cipherLetter) - 0x61)
+                    self.map[cipherLetter] = letters
                 if plainLetter is not None and plainLetter.islower():
-                    self.map[cipherLetter] = Letters(plainLetter)
+                    letters.assign(plainLetter)
                     processed.add(cipherLetter)
                 else:
-                    letters = Letters.all()
+                    letters.bits = Letters.ALL_BITS
                     if noLetterToItself:
                         letters.unset(cipherLetter)
-                    self.map[cipherLetter] = letters
         if decrypted:
             self.reduce()
 
@@ -153,6 +277,13 @@ class Cipher:
     def __contains__(self, key):  return key in self.map
     def __getitem__(self, key):   return self.map[key]
 
+    def snapshot(self):
+        "a copy of the possibles, to restore later"
+        return self.slots[:]
+
+    def restore(self, snapshot):
+        self.slots[:] = snapshot
+
     def process(self, crypted, possibleDecrypts):
         self.batchProcess([(crypted, possibleDecrypts)])
 
@@ -167,64 +298,92 @@ class Cipher:
                     for guess in possibleDecrypts:
                         possibles.set(guess[i])
 
+    def processMasks(self, letterMasks):
+        self.batchProcessMasks([letterMasks])
+
+    def batchProcessMasks(self, wordsLetterMasks):
+        "like batchProcess, given each word's (slot, plain letters bitmask)s"
+        slots = self.slots
+        processed = set()
+        for letterMasks in wordsLetterMasks:
+            for slot, bits in letterMasks:
+                if slot not in processed:
+                    processed.add(slot)
+                    slots[slot] = bits
+
     @property
     def solved(self):
         return all(possibles.solved for possibles in self.values())
 
+    MAX_SUBSET = 11
+
     def reduce(self):
         # for all len(1) remove from others
         # for all len(2) if there is a matching len(2) remove from others
         # for all len(3) if 2 other matching len(3) remove from others
         # for all len(4) if 3 other matching len(4) remove from others
         # etc...
-        possiblesByLen = self._preparePossiblesByLen(self.values())
-        if possiblesByLen[0]:
-            print ("No possibles for {}"
-                               .format([k for k,v in self.map.items()
-                                        if len(v) == 0]))
-        reductionsTotal = 0
-        for go in range(1, 12):
-            reductionsThisGo = 0
-            for n in range(1, 13-go):
-                reductions = self._reduceBy(n, possiblesByLen)
-                reductionsThisGo += reductions
-                reductionsTotal  += reductions
-            if reductionsThisGo == 0:
-                break
-            possiblesToPrepare = chain.from_iterable(possiblesByLen)
-            possiblesByLen = self._preparePossiblesByLen(possiblesToPrepare)
-        return reductionsTotal
-
-    def _preparePossiblesByLen(self, possiblesToPrepare):
-        possiblesByLen = [[] for l in range(27)]
-        for possibles in possiblesToPrepare:
-            possiblesByLen[len(possibles)].append(possibles)
-        return possiblesByLen
-
-    def _reduceBy(self, n, possiblesByLen):
-        reductions = 0
-        possiblesByLen[n].sort()
-        unreducingPossibles = []
-        for letters, group in groupby(possiblesByLen[n]):
-            matchingPossibles = list(group)
-            lenMatching = len(matchingPossibles)
-            if lenMatching == n:
-                self._reducePossibles(letters, n+1, possiblesByLen)
-                reductions += 1
-            elif lenMatching < n:
-                unreducingPossibles.extend(matchingPossibles)
-            else:
+        # Cipher letters are grouped by their bitmask of possibles, and only
+        # the groups that cipher letters have just moved in or out of are
+        # checked again, smallest first.  Since the last reduce left no group
+        # to act on, that goes for the letters changed since then too, unless
+        # a restore has given any of them back possibles.  The groups locked
+        # last time that are not checked again still count as reductions.
+        byBits = {}
+        for cipherLetter, possibles in self.map.items():
+            byBits.setdefault(possibles.bits, set()).add(cipherLetter)
+        if 0 in byBits:
+            print ("No possibles for {}".format(sorted(byBits[0])))
+        slots = self.slots
+        reduced = self._reduced
+        if reduced is None or any(new & ~old
+                                  for old, new in zip(reduced, slots)):
+            queued = set(byBits)
+            lockedBits = set()
+        else:
+            queued = set()
+            for old, new in zip(reduced, slots):
+                if old != new:
+                    queued.update((old, new))
+            lockedBits = self._lockedBits - queued
+        queued.discard(0)
+        worklist = [(bitCount(bits), bits) for bits in queued]
+        heapify(worklist)
+        locked = set()
+        while worklist:
+            n, bits = heappop(worklist)
+            queued.discard(bits)
+            if n > self.MAX_SUBSET:
+                continue
+            group = byBits.get(bits, set()) - locked
+            if len(group) < n:
+                continue
+            if len(group) > n:
                 # FIXME work on a copy of possibles and only
                 # assign if there are no errors
-                print("Homophonic substitution to {}".format(letters))
-        possiblesByLen[n] = unreducingPossibles
-        return reductions
-
-    def _reducePossibles(self, letters, m, possiblesByLen):
-        for o in range(m, 27):
-            possiblesToReduce = possiblesByLen[o]
-            for possibles in possiblesToReduce:
-                possibles.unset(letters)
+                print("Homophonic substitution to {}".format(maskGlob(bits)))
+                continue
+            # n cipher letters between them have these n plain letters, so
+            # no other cipher letter (with more possibles) can have them
+            locked |= group
+            lockedBits.add(bits)
+            for oldBits in [other for other in byBits
+                            if other & bits and other != bits]:
+                letters = byBits[oldBits] - locked
+                if not letters:
+                    continue
+                newBits = oldBits & ~bits
+                for cipherLetter in letters:
+                    self.map[cipherLetter].bits = newBits
+                byBits[oldBits] -= letters
+                byBits.setdefault(newBits, set()).update(letters)
+                for changed in (oldBits, newBits):
+                    if changed and changed not in queued:
+                        queued.add(changed)
+                        heappush(worklist, (bitCount(changed), changed))
+        self._reduced = slots[:]
+        self._lockedBits = lockedBits
+        return len(lockedBits)
 
     def decrypt(self, crypted):
         buffer = StringIO()
@@ -249,6 +408,8 @@ class Word:
         self.links    = []
         self.count    = None
         self._guesses = []
+        self._projections = {}
+        self._columns = None
 
     def __repr__(self):
         return "{0} ({1})".format(self.crypted, self.count)
@@ -269,19 +430,85 @@ class Word:
     def guesses(self, g):
         self._guesses = g
         self.count = len(g)
+        self._projections = {}
+        self._columns = None
+
+    def projections(self, sharedLetters):
+        "the guesses grouped by the plain letters they give sharedLetters"
+        projections = self._projections.get(sharedLetters)
+        if projections is None:
+            getter = itemgetter(*(self.crypted.index(c)
+                                  for c in sharedLetters))
+            projections = {}
+            for guess in self._guesses:
+                projections.setdefault(getter(guess), []).append(guess)
+            self._projections[sharedLetters] = projections
+        return projections
 
     def glob(self, cipher):
-        buffer = StringIO()
-        for char in self.crypted:
-            if char.islower():
-                buffer.write(cipher[char].glob())
-            else:
-                buffer.write(char)
-        return buffer.getvalue()
-
-    def regex(self, cipher):
-        pattern = self.glob(cipher).replace('?', '.')
-        return re.compile(pattern)
+        slots = cipher.slots
+        return "".join(maskGlob(slots[ord(char) - 0x61]) if char.islower()
+                       else char for char in self.crypted)
+
+    def masks(self, cipher):
+        "the bitmask of possible letters for each position, None if fixed"
+        slots = cipher.slots
+        return tuple(slots[ord(char) - 0x61] if char.islower() else None
+                     for char in self.crypted)
+
+    def columns(self):
+        """
+        for each cipher letter, the plain letters the guesses give it as
+        bytes, and the bitmask of those letters
+        """
+        if self._columns is None:
+            joined = "".join(self._guesses).encode()
+            step = len(self.crypted)
+            columns = []
+            for cipherLetter in sorted(self.cryptedLetters - {"'"}):
+                column = joined[self.crypted.index(cipherLetter)::step]
+                present = 0
+                for letter in set(column):
+                    present |= 1 << letter - 0x61
+                columns.append((ord(cipherLetter) - 0x61, column, present))
+            self._columns = columns
+        return self._columns
+
+    def filterGuesses(self, cipher):
+        "the guesses that fit the possibles in cipher"
+        slots = cipher.slots
+        allGuesses = kept = (1 << self.count) - 1
+        for slot, column, present in self.columns():
+            if present & ~slots[slot]:
+                # a "1" for each guess with a possible letter, lowest first
+                kept &= int(column.translate(maskTable(slots[slot]))[::-1], 2)
+        if kept == allGuesses:
+            return self._guesses
+        return [guess for guess, digit in zip(self._guesses, bin(kept)[:1:-1])
+                if digit == "1"]
+
+    def letterMasks(self):
+        "the (slot, bitmask of plain letters) the guesses give each letter"
+        return [(slot, present) for slot, column, present in self.columns()]
+
+    def join(self, word2, sharedLetters):
+        """
+        the guesses of both words that give sharedLetters the same plain
+        letters, or None if there are none
+        """
+        projections1 = self.projections(sharedLetters)
+        projections2 = word2.projections(sharedLetters)
+        common = projections1.keys() & projections2.keys()
+        if not common:
+            return None
+        return (self._keepProjections(projections1, common),
+                word2._keepProjections(projections2, common))
+
+    def _keepProjections(self, projections, keys):
+        if len(keys) == len(projections):
+            return self._guesses
+        kept = set(chain.from_iterable(projections[key] for key in keys))
+        return [guess for guess in self._guesses if guess in kept]
 
     def decrypt(self, cipher):
         return cipher.decrypt(self.crypted)
@@ -290,6 +517,86 @@ class Word:
         shared = self.cryptedLetters & word2.cryptedLetters
         return "".join(sorted(shared))
 
+#---------------------------------------------------------------------------
+if numpy is not None:
+    # the bitmask of each (lowercase) letter byte
+    LETTER_BITS = numpy.zeros(256, numpy.uint32)
+    LETTER_BITS[0x61:0x61+26] = 1 << numpy.arange(26, dtype=numpy.uint32)
+
+class ArrayWord(Word):
+    """
+    A Word that also holds its guesses as an (n, len) uint8 NumPy array, so
+    filtering them is done with whole array operations
+    """
+    def __init__(self, cryptedWord):
+        super().__init__(cryptedWord)
+        letters = sorted(self.cryptedLetters - {"'"})
+        self.slots     = [ord(c) - 0x61 for c in letters]
+        self.positions = [cryptedWord.index(c) for c in letters]
+        self._matrix = None
+        self._bits   = None
+        self._codes  = {}
+
+    @Word.guesses.setter
+    def guesses(self, g):
+        Word.guesses.fset(self, g)
+        self._matrix = None
+        self._bits   = None
+        self._codes  = {}
+
+    def matrix(self):
+        if self._matrix is None:
+            joined = "".join(self._guesses).encode()
+            self._matrix = numpy.frombuffer(joined, numpy.uint8).reshape(
+                self.count, len(self.crypted))
+        return self._matrix
+
+    def bits(self):
+        "the bitmask of the plain letter each guess gives each cipher letter"
+        if self._bits is None:
+            self._bits = LETTER_BITS[self.matrix()[:, self.positions]]
+        return self._bits
+
+    def filterGuesses(self, cipher):
+        slots = cipher.slots
+        possibles = numpy.array([slots[slot] for slot in self.slots],
+                                numpy.uint32)
+        return self._keep((self.bits() & possibles).all(axis=1))
+
+    def letterMasks(self):
+        present = numpy.bitwise_or.reduce(self.bits(), axis=0)
+        return list(zip(self.slots, present.tolist()))
+
+    def codes(self, sharedLetters):
+        "each guess's plain letters for sharedLetters, packed in an int"
+        codes = self._codes.get(sharedLetters)
+        if codes is None:
+            matrix = self.matrix()
+            codes = numpy.zeros(self.count, numpy.int64)
+            for c in sharedLetters.replace("'", ""):
+                column = matrix[:, self.crypted.index(c)]
+                codes = codes << 5 | (column & 0x1f)
+            self._codes[sharedLetters] = codes
+        return codes
+
+    def join(self, word2, sharedLetters):
+        if len(sharedLetters) > 12:
+            # too many to pack into an int64
+            return super().join(word2, sharedLetters)
+        codes1 = self.codes(sharedLetters)
+        codes2 = word2.codes(sharedLetters)
+        common = numpy.intersect1d(codes1, codes2)
+        if not len(common):
+            return None
+        return (self._keep(numpy.isin(codes1, common)),
+                word2._keep(numpy.isin(codes2, common)))
+
+    def _keep(self, kept):
+        if kept.all():
+            return self._guesses
+        guesses = self._guesses
+        return [guesses[i] for i in numpy.flatnonzero(kept).tolist()]
+
 #---------------------------------------------------------------------------
 #class SolveAttempt:
 #    def __init__(self, words):
@@ -297,19 +604,36 @@ class Word:
 #
 #---------------------------------------------------------------------------
 class Solver:
-    def __init__(self, catalog, crypted, known):
+    def __init__(self, catalog, crypted, known, useNumpy=False, profile=None):
+        # catalog can also be a list of catalogs, smallest first, see solve()
+        catalogs = list(catalog) if isinstance(catalog, (list, tuple)) \
+                   else [catalog]
+        self.timings = {}
+        # with a profile the catalog queries are counted too
+        self.profile = profile or Profile()
+        if profile is not None:
+            catalogs = [ProfilingCatalog(catalog, profile)
+                        for catalog in catalogs]
         cryptedLetters, knownLetters = self._parse(crypted, known)
         cryptedWords = re.findall(r"[a-z']+", crypted)
         # using Counter instead of set maintains order which makes the
         # unittests simpler, otherwise set would work just fine
         uniqueWords  = Counter(cryptedWords)
-        self.cat          = catalog
+        self.catalogs     = catalogs
+        self.cat          = catalogs[0]
         self.cryptedWords = cryptedWords
-        self.words        = [Word(word) for word in uniqueWords]
+        # fall back to pure Python if NumPy is not installed
+        wordClass = ArrayWord if useNumpy and numpy is not None else Word
+        self.words        = [wordClass(word) for word in uniqueWords]
         self.cipher       = Cipher(cryptedLetters, knownLetters,
                                    noLetterToItself=True)
         self.root         = None
-        self.unlinked     = []
+        self.roots        = []
+        self.neighbours   = self._buildNeighbours(self.words)
+        # the index in catalogs of the catalog each word is looked up in
+        self.tiers        = dict.fromkeys(self.words, 0)
+        # the cipher with only the known letters, see solve() and addKnown()
+        self.start        = None
 
     def _parse(self, crypted, known):
         cLen = len(crypted)
@@ -340,6 +664,18 @@ class Solver:
                         knownLetters.append(plainLetter)
         return "".join(cryptedLetters), "".join(knownLetters)
 
+    @staticmethod
+    def _buildNeighbours(words):
+        "map each word to the (sharedLetters, word) pairs it constrains"
+        neighbours = {word: [] for word in words}
+        for i, word1 in enumerate(words):
+            for word2 in words[i+1:]:
+                sharedLetters = Word.sharedLetters(word1, word2)
+                if sharedLetters:
+                    neighbours[word1].append((sharedLetters, word2))
+                    neighbours[word2].append((sharedLetters, word1))
+        return neighbours
+
     @property
     def solved(self):
         return all(word.solved for word in self.words)
@@ -349,66 +685,197 @@ class Solver:
         return " ".join(self.cryptedWords)
 
     def solve(self):
-        self.prepare()
+        "solve from the known letters, looking words up in later catalogs"
+        # only the words left with no guesses go on to the next catalog, or
+        # every word if the cipher contradicts itself, and then the solve
+        # starts again from the known letters
+        self.timings = {}
+        self.start = start = self.cipher.snapshot()
+        self._solveOnce()
+        for tier in range(1, len(self.catalogs)):
+            escalate = self._wordsToEscalate(tier)
+            if not escalate:
+                break
+            print("Looking up {} words in catalog {}"
+                  .format(len(escalate), tier + 1))
+            self.profile.count("escalated", len(escalate))
+            for word in escalate:
+                self.tiers[word] = tier
+            self.cipher.restore(start)
+            for word in self.words:
+                word.guesses = []
+            self._solveOnce()
+
+    def addKnown(self, known):
+        "add known letters like gur=the to a solve, True if it was kept"
+        # the words keep their guesses, filtered with the narrowed cipher,
+        # and only those that lost some are filtered against their
+        # neighbours.  If the letters contradict the guesses it starts again.
+        assignments = [(cipherLetter, plainLetter)
+                       for assignment in re.findall(r"([a-z]+)=([a-z]+)",
+                                                    known)
+                       for cipherLetter, plainLetter in zip(*assignment)
+                       if cipherLetter in self.cipher]
+        if self.start is None:
+            self._assign(assignments)
+            self.solve()
+            return False
+        live = self.cipher.snapshot()
+        self.cipher.restore(self.start)
+        self._assign(assignments)
+        self.start = self.cipher.snapshot()
+        self.cipher.restore(live)
+        if all(plainLetter in self.cipher[cipherLetter]
+               for cipherLetter, plainLetter in assignments):
+            self._assign(assignments)
+            if all(self.cipher.values()) and self._filterKnown(live):
+                return True
+        print("The known letters contradict the guesses, solving again")
+        self.profile.count("resolved")
+        self.cipher.restore(self.start)
+        self.tiers = dict.fromkeys(self.words, 0)
+        for word in self.words:
+            word.guesses = []
+        self.solve()
+        return False
+
+    def _assign(self, assignments):
+        for cipherLetter, plainLetter in assignments:
+            self.cipher[cipherLetter].assign(plainLetter)
+        self.cipher.reduce()
+
+    def _filterKnown(self, before):
+        # filter the words with a letter the cipher has changed, and narrow
+        # the cipher with the guesses they have left, until it stops
+        # changing.  Then filter with words from those that lost guesses.
+        # False if a word loses all its guesses.
+        slots = self.cipher.slots
+        changed = set()
+        while True:
+            changedSlots = {slot for slot, (old, new)
+                            in enumerate(zip(before, slots)) if old != new}
+            if not changedSlots:
+                break
+            filteredWords = []
+            for word in self.words:
+                if not word.count or not any(ord(char) - 0x61 in changedSlots
+                                             for char in word.cryptedLetters
+                                             if char.islower()):
+                    continue
+                filtered = word.filterGuesses(self.cipher)
+                if not filtered:
+                    return False
+                if len(filtered) != word.count:
+                    self.profile.count("pruned.known",
+                                       word.count - len(filtered))
+                    word.guesses = filtered
+                    filteredWords.append(word)
+            before = self.cipher.snapshot()
+            for word in filteredWords:
+                for slot, bits in word.letterMasks():
+                    slots[slot] &= bits
+            self._reduce()
+            changed.update(filteredWords)
+        counts = [word.count for word in self.words]
+        self._timeDo(lambda: self.filter([word for word in self.words
+                                          if word in changed]), "filter")
+        return (all(word.count or not count
+                    for word, count in zip(self.words, counts)) and
+                all(self.cipher.values()))
+
+    def _wordsToEscalate(self, tier):
+        lower = [word for word in self.words if self.tiers[word] < tier]
+        if not all(self.cipher.values()):
+            return lower
+        return [word for word in lower if word.unsolvable]
+
+    def _catalog(self, word):
+        return self.catalogs[self.tiers[word]]
+
+    def _solveOnce(self):
+        self._timeDo(self.prepare, "prepare")
         #self._debug()
         #self.cipher._debug()
-        self.match()
+        self._timeDo(self.match, "match")
         #self._debug()
         #self.cipher._debug()
         #self._printColumns()
-        self.filter()
+        self._timeDo(self.filter, "filter")
+
+    def _timeDo(self, func, name):
+        tic = perf_counter_ns()
+        retval = func()
+        toc = perf_counter_ns()
+        duration = (toc - tic) / 10**9
+        self.timings[name] = self.timings.get(name, 0.0) + duration
+        self.profile.phases.setdefault(name, []).append(duration)
+        return retval
 
     def prepare(self):
         for word in self.words:
-            glob = word.glob(self.cipher)
-            word.count = self.cat.count(word.pattern, glob)
+            glob = word.masks(self.cipher)
+            cat = self._catalog(word)
+            word.count = self._countGuesses(cat, word, glob)
             if word.count == 1:   # too easy
-                word.guesses = self.cat.words(word.pattern, glob)
-                self.cipher.process(word.crypted, word.guesses)
-        words = deque(sorted(self.words, key=attrgetter("count")))
-        bestSort = (len(words)+1, [])
-        for n in range(len(words)):
-            self._buildTree(words)
-            unlinkedCount = len(self.unlinked)
-            if unlinkedCount == 0:
-                break
-            elif unlinkedCount < bestSort[0]:
-                bestSort = (unlinkedCount, deque(words))
-            # try for no more than 2 unlinked words
-            #if len(self.unlinked) < 3:
-            #    break
-            for word in words:
-                word.links = []
-            words.rotate(-1)
-        else:
-            # back at the beginning
-            self._buildTree(bestSort[1])
-            #self._buildTree(self.words)
-
-    def _buildTree(self, words):
-        others  = list(words)
-        visited = {words[0]}
-        queue   = deque(visited)
-        while queue:
-            word1 = queue.popleft()
-            others.remove(word1)
-            for word2 in others:
-                letters = Word.sharedLetters(word1, word2)
-                if letters and word2 not in visited:
-                    word1.links.append((letters, word2))
-                    visited.add(word2)
-                    queue.append(word2)
-        self.root = words[0]
-        self.unlinked = others
+                word.guesses = cat.words(word.pattern, glob)
+                if word.count:
+                    self.cipher.processMasks(word.letterMasks())
+        with self.profile.phase("buildTrees"):
+            self._buildTrees()
+
+    def _countGuesses(self, cat, word, glob):
+        # when no letter is known, only a letter being itself is ruled out,
+        # and the number of words with the pattern is close enough to order
+        # the words by.  Matching counts the guesses properly.
+        patternCount = getattr(cat, "patternCount", None)
+        if patternCount is not None and all(mask is None or
+                                            bitCount(mask) >= 25
+                                            for mask in glob):
+            count = patternCount(word.pattern)
+            if count is not None:
+                return count
+        return cat.count(word.pattern, glob)
+
+    def _buildTrees(self):
+        # each connected group of words that share letters is linked into a
+        # tree, breadth first from a root with few guesses and many
+        # neighbours, visiting the neighbours with fewer guesses first
+        byCount = sorted(self.words, key=attrgetter("count"))
+        order = {word: n for n, word in enumerate(byCount)}
+        neighbours = self.neighbours
+        for word in self.words:
+            word.links = []
+        roots = []
+        visited = set()
+        for root in sorted(byCount, key=lambda word: (word.count,
+                                                      -len(neighbours[word]))):
+            if root in visited:
+                continue
+            roots.append(root)
+            visited.add(root)
+            queue = deque([root])
+            while queue:
+                word1 = queue.popleft()
+                for letters, word2 in sorted(neighbours[word1],
+                                             key=lambda link: order[link[1]]):
+                    if word2 not in visited:
+                        word1.links.append((letters, word2))
+                        visited.add(word2)
+                        queue.append(word2)
+        self.roots = roots
+        self.root  = roots[0] if roots else None
 
     def match(self):
         startCount = prevCount = sum(word.count for word in self.words)
         stuck = 0
+        profile = self.profile
         for go in range(10):
-            count  = self._matchLinked()
-            count += self._matchUnlinked()
-            self.cipher.reduce()
+            with profile.phase("match.go", perGo=True):
+                count  = self._matchLinked()
+                self._reduce()
             print("Matching {} possible words at go {}".format(count, go))
+            profile.peak("guesses", max(word.count for word in self.words))
+            profile.peak("totalGuesses", count)
             if self.solved:
                 break
             if count >= prevCount:
@@ -418,144 +885,123 @@ class Solver:
             else:
                 stuck = 0
             prevCount = count
+        profile.count("pruned.match", startCount - prevCount)
         return startCount - prevCount
 
-    def _matchLinked(self):
-        count = 0
-        visited = {self.root}
-        queue   = deque(visited)
-        while queue:
-            word1 = queue.popleft()
-            self._matchWord(word1)
-            count += word1.count
-            for letters, word2 in word1.links:
-                if word2 not in visited:
-                    visited.add(word2)
-                    queue.append(word2)
-        return count
+    def _reduce(self):
+        with self.profile.phase("reduce"):
+            numReductions = self.cipher.reduce()
+        self.profile.count("reductions", numReductions)
+        return numReductions
 
-    def _matchUnlinked(self):
+    def _matchLinked(self):
+        # one tree at a time, each from its root
         count = 0
-        for word in self.unlinked:
-            self._matchWord(word)
-            count += word.count
+        for root in self.roots:
+            queue = deque([root])
+            while queue:
+                word1 = queue.popleft()
+                self._matchWord(word1)
+                count += word1.count
+                queue.extend(word2 for letters, word2 in word1.links)
         return count
 
     def _matchWord(self, word):
         if not word.solved:
-            glob = word.glob(self.cipher)
-            word.guesses = self.cat.words(word.pattern, glob)
+            glob = word.masks(self.cipher)
+            word.guesses = self._catalog(word).words(word.pattern, glob)
             if word.count:
-                self.cipher.process(word.crypted, word.guesses)
+                self.cipher.processMasks(word.letterMasks())
 
-    def filter(self):
+    def filter(self, changed=None):
+        "changed are the words to start from, by default all of them"
         totalFiltered = 0
+        if changed is None:
+            changed = self.words
+        profile = self.profile
         # FIXME if a word becomes unsolvable remove it and start again
-        for go in range(10):
-            numFilteredWithWords = self._filterWithWords()
-            print("Filtered {} words with words in go {}"
-                  .format(numFilteredWithWords, go))
-            totalFiltered += numFilteredWithWords
-            if numFilteredWithWords:
-                self.cipher.batchProcess(((word.crypted, word.guesses)
-                                          for word in self.words
-                                          if word.count))
-                numReductions = self.cipher.reduce()
-                print("Reduced {} cipher possibles in go {}".format(numReductions, go))
-            else:
-                numReductions = 0
-            if numReductions:
-                numFilteredWithCipher = self._filterWithCipher()
+        for go in count():
+            with profile.phase("filter.go", perGo=True):
+                numFilteredWithWords = self._filterWithWords(changed)
+                print("Filtered {} words with words in go {}"
+                      .format(numFilteredWithWords, go))
+                profile.count("pruned.filterWithWords", numFilteredWithWords)
                 totalFiltered += numFilteredWithWords
+                if numFilteredWithWords:
+                    self.cipher.batchProcessMasks(word.letterMasks()
+                                                  for word in self.words
+                                                  if word.count)
+                    numReductions = self._reduce()
+                    print("Reduced {} cipher possibles in go {}"
+                          .format(numReductions, go))
+                else:
+                    numReductions = 0
+                if not numReductions:
+                    break
+                counts = [word.count for word in self.words]
+                numFilteredWithCipher = self._filterWithCipher()
+                profile.count("pruned.filterWithCipher", numFilteredWithCipher)
+                totalFiltered += numFilteredWithCipher
                 print("Filtered {} words with cipher in go {}"
                       .format(numFilteredWithCipher, go))
-            else:
-                break
+                changed = [word for word, oldCount in zip(self.words, counts)
+                           if word.count != oldCount]
         return totalFiltered
 
-    def _filterWithWords(self):
+    def _filterWithWords(self, changed=None):
+        # arc consistency: filter each pair of words sharing letters, and
+        # when a word loses guesses check the pairs with its other
+        # neighbours again, until nothing changes
+        if changed is None:
+            changed = self.words
+        queue  = deque()
+        queued = set()
+        def enqueue(word1, word2, sharedLetters):
+            arc = (word1, word2) if id(word1) < id(word2) else (word2, word1)
+            if arc not in queued:
+                queued.add(arc)
+                queue.append((sharedLetters, word1, word2))
+        for word1 in changed:
+            for sharedLetters, word2 in self.neighbours[word1]:
+                enqueue(word1, word2, sharedLetters)
         numFilteredThisGo = 0
-        for i, word1 in enumerate(self.words):
-            if word1.unsolvable:
+        while queue:
+            sharedLetters, word1, word2 = queue.popleft()
+            arc = (word1, word2) if id(word1) < id(word2) else (word2, word1)
+            queued.discard(arc)
+            if word1.unsolvable or word2.unsolvable:
                 continue
-            for word2 in self.words[i+1:] + self.words[:i]:
-                if word2.unsolvable:
-                    continue
-                if word1.solved and word2.solved:
-                    continue
-                sharedLetters = Word.sharedLetters(word1, word2)
-                if not sharedLetters:
-                    continue
-                numFiltered = self._filterGuesses(sharedLetters,
-                                                  word1, word2)
-                numFilteredThisGo += numFiltered
+            if word1.solved and word2.solved:
+                continue
+            count1 = word1.count
+            count2 = word2.count
+            numFiltered = self._filterGuesses(sharedLetters, word1, word2)
+            numFilteredThisGo += numFiltered
+            for word, oldCount, partner in ((word1, count1, word2),
+                                            (word2, count2, word1)):
+                if word.count != oldCount:
+                    for letters, other in self.neighbours[word]:
+                        if other is not partner:
+                            enqueue(word, other, letters)
         return numFilteredThisGo
 
     def _filterGuesses(self, sharedLetters, word1, word2):
-        filtered1 = []
-        filtered2 = []
-        indices1 = [word1.crypted.index(c) for c in sharedLetters]
-        indices2 = [word2.crypted.index(c) for c in sharedLetters]
-        getter1 = itemgetter(*indices1)
-        getter2 = itemgetter(*indices2)
-        guesses1 = sorted(word1.guesses, key=getter1)
-        guesses2 = sorted(word2.guesses, key=getter2)
-        it1 = iter(guesses1)
-        it2 = iter(guesses2)
-        guess1 = guess2 = None
-        prevLetters1 = prevLetters2 = None
-        letters1 = letters2 = None
-        def nextLetters1():
-            nonlocal guess1, prevLetters1, letters1
-            guess1 = next(it1, None)
-            prevLetters1 = letters1
-            letters1 = getter1(guess1) if guess1 else ""
-        def nextLetters2():
-            nonlocal guess2, prevLetters2, letters2
-            guess2 = next(it2, None)
-            prevLetters2 = letters2
-            letters2 = getter2(guess2) if guess2 else ""
-        nextLetters1()
-        nextLetters2()
-        while guess1 is not None or guess2 is not None:
-            if letters1 == letters2:
-                filtered1.append(guess1)
-                filtered2.append(guess2)
-                nextLetters1()
-                nextLetters2()
-            elif letters1 == prevLetters2:
-                filtered1.append(guess1)
-                nextLetters1()
-            elif guess2 is None:
-                nextLetters1()
-            elif letters2 == prevLetters1:
-                filtered2.append(guess2)
-                nextLetters2()
-            elif guess1 is None:
-                nextLetters2()
-            elif letters1 < letters2:
-                nextLetters1()
-            else:
-                nextLetters2()
+        # only keep the guesses that give the shared letters the same
+        # plain letters as some guess for the other word
+        joined = word1.join(word2, sharedLetters)
         numFiltered = 0
-        newCount1 = len(filtered1)
-        newCount2 = len(filtered2)
-        if word1.count != newCount1 and newCount2:
-            numFiltered += word1.count - newCount1
-            word1.guesses = filtered1
-        if word2.count != newCount2 and newCount1:
-            numFiltered += word2.count - newCount2
-            word2.guesses = filtered2
+        if joined is None:
+            return numFiltered
+        for word, filtered in zip((word1, word2), joined):
+            if len(filtered) != word.count:
+                numFiltered += word.count - len(filtered)
+                word.guesses = filtered
         return numFiltered
 
     def _filterWithCipher(self):
         numFiltered = 0
         for word in self.words:
-            regex = word.regex(self.cipher)
-            filtered = []
-            for guess in word.guesses:
-                if regex.fullmatch(guess):
-                    filtered.append(guess)
+            filtered = word.filterGuesses(self.cipher)
             newCount = len(filtered)
             if word.count != newCount:
                 numFiltered += word.count - newCount
@@ -565,10 +1011,233 @@ class Solver:
     def decrypt(self):
         return self.cipher.decrypt(self.crypted)
 
+    def search(self):
+        """
+        Generate each full decryption that is consistent with one
+        substitution key, as a dict of cipher letter to plain letter.
+        Words without any guesses are left out of the search.
+        """
+        key, used, firstIndices, candidates = self._startSearch()
+
+        def searchFrom(candidates):
+            if not candidates:
+                yield dict(key)
+                return
+            word = self._nextSearchWord(candidates, key, firstIndices)
+            for guess in candidates[word]:
+                added = {}
+                for letter, i in firstIndices[word]:
+                    if letter not in key:
+                        added[letter] = guess[i]
+                key.update(added)
+                used.update(added.values())
+                remaining = self._forwardCheck(candidates, word, firstIndices,
+                                               added)
+                if remaining is not None:
+                    yield from searchFrom(remaining)
+                for letter, plain in added.items():
+                    del key[letter]
+                    used.discard(plain)
+
+        yield from searchFrom(candidates)
+
+    def best(self, k=10, maxSteps=100000):
+        "the k (score, key)s with the most likely words, by catalog weight"
+        # a decryption scores the sum of the log weights of its words.  The
+        # search tries the heaviest guesses first, keeps the best k found in
+        # a heap, and cuts off a branch when even the heaviest guesses of the
+        # words left could not beat them.  After maxSteps guesses it gives
+        # the best found so far.
+        key, used, firstIndices, candidates = self._startSearch()
+        logWeights = {}
+        for word, guesses in candidates.items():
+            weights = self._weights(word)
+            logWeights[word] = {guess: log(max(weight, 1e-300))
+                                for guess, weight in weights.items()}
+            guesses.sort(key=logWeights[word].get, reverse=True)
+        found  = []
+        serial = 0
+        steps  = 0
+
+        def bestFrom(candidates, score):
+            nonlocal serial, steps
+            bound = score + sum(logWeights[word][guesses[0]]
+                                for word, guesses in candidates.items())
+            if len(found) == k and bound <= found[0][0]:
+                return
+            if not candidates:
+                # on equal scores the decryption found first wins
+                serial += 1
+                if len(found) == k:
+                    heapreplace(found, (score, -serial, dict(key)))
+                else:
+                    heappush(found, (score, -serial, dict(key)))
+                return
+            word = self._nextSearchWord(candidates, key, firstIndices)
+            for guess in candidates[word]:
+                steps += 1
+                if steps > maxSteps:
+                    return
+                added = {}
+                for letter, i in firstIndices[word]:
+                    if letter not in key:
+                        added[letter] = guess[i]
+                key.update(added)
+                used.update(added.values())
+                remaining = self._forwardCheck(candidates, word, firstIndices,
+                                               added)
+                if remaining is not None:
+                    bestFrom(remaining, score + logWeights[word][guess])
+                for letter, plain in added.items():
+                    del key[letter]
+                    used.discard(plain)
+
+        if k > 0:
+            bestFrom(candidates, 0.0)
+        return [(score, key) for score, n, key in sorted(found, reverse=True)]
+
+    def _startSearch(self):
+        key = {}
+        for letter, possibles in self.cipher.items():
+            if possibles.solved:
+                key[letter] = str(possibles)
+        used = set(key.values())
+        firstIndices = {}
+        candidates = {}
+        for word in self.words:
+            if word.count:
+                indices = [(letter, word.crypted.index(letter))
+                           for letter in sorted(word.cryptedLetters)
+                           if letter.islower()]
+                firstIndices[word] = indices
+                candidates[word] = [guess for guess in word.guesses
+                                    if self._fitsKey(guess, indices,
+                                                     key, used)]
+        return key, used, firstIndices, candidates
+
+    def _nextSearchWord(self, candidates, key, firstIndices):
+        # the word with fewest guesses left, then the word with the most
+        # letters already in the key, so conflicts show up early
+        return min(candidates,
+                   key=lambda w: (len(candidates[w]),
+                                  -sum(letter in key
+                                       for letter, i in firstIndices[w])))
+
+    def _weights(self, word):
+        weights = getattr(self._catalog(word), "weights", None)
+        if weights is None:
+            return dict.fromkeys(word.guesses, 1.0)
+        return weights(word.guesses)
+
+    def _fitsKey(self, guess, indices, key, used):
+        assigned = {}
+        for letter, i in indices:
+            plain = guess[i]
+            known = key.get(letter)
+            if known is None:
+                if (plain in used or plain in assigned.values() or
+                    plain not in self.cipher[letter]):
+                    return False
+                assigned[letter] = plain
+            elif known != plain:
+                return False
+        return True
+
+    def _forwardCheck(self, candidates, chosen, firstIndices, added):
+        # take away the guesses of the other words that no longer fit with
+        # the letters just added to the key, or None if a word has none left
+        addedPlains = set(added.values())
+        remaining = {}
+        for word, guesses in candidates.items():
+            if word is chosen:
+                continue
+            indices = firstIndices[word]
+            if not any(letter in added for letter, i in indices):
+                checks = [i for letter, i in indices]
+                guesses = [guess for guess in guesses
+                           if not any(guess[i] in addedPlains
+                                      for i in checks)]
+            else:
+                guesses = [guess for guess in guesses
+                           if all(guess[i] == added[letter]
+                                  if letter in added
+                                  else guess[i] not in addedPlains
+                                  for letter, i in indices)]
+            if not guesses:
+                return None
+            remaining[word] = guesses
+        return remaining
+
+    def climb(self, quadgrams, restarts=10, seed=0):
+        "the (score, key) reading most like the catalog's words by quadgrams"
+        # for when some words are not in the catalog.  The solved letters
+        # stay fixed, the rest start on one of their possibles and pairs of
+        # plain letters are swapped while that raises the score, from several
+        # random starts.
+        rand = random.Random(seed)
+        letters = sorted(self.cipher.keys())
+        fixed = {letter: str(possibles)
+                 for letter, possibles in self.cipher.items()
+                 if possibles.solved}
+        free = [letter for letter in letters if letter not in fixed]
+        spare = [chr(0x61 + x) for x in range(26)
+                 if chr(0x61 + x) not in fixed.values()]
+        crypted = Quadgrams.encode(" {} ".format(self.crypted))
+        plainOf = list(range(27))
+        for letter, plain in fixed.items():
+            plainOf[ord(letter) - 0x61] = ord(plain) - 0x61
+
+        def scoreWith(plains):
+            for letter, plain in zip(free, plains):
+                plainOf[ord(letter) - 0x61] = ord(plain) - 0x61
+            return quadgrams.score([plainOf[symbol] for symbol in crypted])
+
+        best = (None, [])
+        for attempt in range(max(restarts, 1)):
+            # start each free letter on one of its possibles if there is one
+            # not yet taken, the letters left over are there to swap in
+            unused = list(spare)
+            rand.shuffle(unused)
+            plains = []
+            for letter in free:
+                possibles = [plain for plain in unused
+                             if plain in self.cipher[letter]]
+                plain = rand.choice(possibles) if possibles else unused[0]
+                unused.remove(plain)
+                plains.append(plain)
+            plains += unused
+            score = scoreWith(plains)
+            improved = True
+            while improved:
+                improved = False
+                for i in range(len(free)):
+                    for j in range(i + 1, len(plains)):
+                        plains[i], plains[j] = plains[j], plains[i]
+                        newScore = scoreWith(plains)
+                        if newScore > score:
+                            score = newScore
+                            improved = True
+                        else:
+                            plains[i], plains[j] = plains[j], plains[i]
+            if best[0] is None or score > best[0]:
+                best = (score, plains[:len(free)])
+        key = dict(fixed)
+        key.update(zip(free, best[1]))
+        return best[0], key
+
+    def decryptWith(self, key):
+        buffer = StringIO()
+        for letter in self.crypted:
+            if letter.islower():
+                buffer.write(key.get(letter, '_'))
+            else:
+                buffer.write(letter)
+        return buffer.getvalue()
+
     def _debug(self):
         print(self.crypted)
-        visited = {self.root}
-        queue   = deque([(0, self.root)])
+        visited = set(self.roots)
+        queue   = deque((0, root) for root in self.roots)
         while queue:
             depth, word1 = queue.popleft()
             if depth:
@@ -580,10 +1249,6 @@ class Solver:
                 if word2 not in visited:
                     visited.add(word2)
                     queue.append((depth, word2))
-        print()
-        for word1 in self.unlinked:
-            print(word1)
-            #pprint(word1.guesses)
         print("")
 
     def print(self):
@@ -610,26 +1275,77 @@ class Solver:
                 if cont == 'b':
                     break
 
-    def _printProduct(self):
-        guesses = []
-        for word in self.words:
-            if word.unsolvable:
-                guesses.append([word.decrypt(self.cipher)])
-            else:
-                guesses.append(word.guesses)
-        for decrypt in product(*guesses):
-            print(" ".join(decrypt))
+    def _printBest(self, k):
+        for score, key in self.best(k):
+            print("{} {:>10.2f}".format(self.decryptWith(key), score))
+
+    def _printProduct(self, limit=None):
+        for key in islice(self.search(), limit):
+            print(self.decryptWith(key))
 
 
 #---------------------------------------------------------------------------
 def main():
-    if len(sys.argv) != 2:
-        print("usage: wssolve CATALOG-FILE")
-        sys.exit(1)
-    path = Path(sys.argv[1])
-    if not path.is_file():
-        print("File %s not found")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(prog="wssolve",
+                                     description="Solve a cryptogram")
+    parser.add_argument("catalogs", metavar="CATALOG-FILE", type=Path,
+                        nargs="+",
+                        help="the catalogs to look words up in, smallest "
+                             "first, a word is only looked up in the next "
+                             "catalog if it isn't found in the one before")
+    parser.add_argument("--backend", choices=BACKENDS,
+                        help="how to query the catalog (default: mmap for a "
+                             "binary catalog, otherwise sqlite)")
+    parser.add_argument("--batch", metavar="PUZZLE-FILE",
+                        help="solve each line of PUZZLE-FILE (- for stdin) "
+                             "and write the results as JSON lines")
+    parser.add_argument("--solutions", metavar="N", type=int,
+                        help="print up to N full decryptions that are "
+                             "consistent with one key, rather than columns "
+                             "of guesses")
+    parser.add_argument("--best", metavar="K", type=int,
+                        help="print the K most likely full decryptions, by "
+                             "the catalog's word weights")
+    parser.add_argument("--serve", metavar="ADDRESS",
+                        help="keep the catalog open and solve requests sent "
+                             "to ADDRESS, either [HOST:]PORT or a Unix socket")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of processes to solve a batch, or "
+                             "requests, with")
+    parser.add_argument("--numpy", action="store_true",
+                        help="filter guesses as NumPy arrays, if NumPy is "
+                             "installed")
+    parser.add_argument("--cache", metavar="N", type=int, default=0,
+                        help="keep the results of the last N catalog queries")
+    parser.add_argument("--persist-cache", action="store_true",
+                        help="save the query cache next to the catalog, and "
+                             "start from it next time")
+    parser.add_argument("--profile", action="store_true",
+                        help="write the time taken by each phase of solving, "
+                             "catalog queries and guesses pruned as JSON")
+    args = parser.parse_args()
+    paths = args.catalogs
+    for path in paths:
+        if not path.is_file():
+            print("File %s not found" % path)
+            sys.exit(1)
+    if args.numpy and numpy is None:
+        print("NumPy is not installed, using pure Python", file=sys.stderr)
+    options = {"useNumpy": args.numpy, "profile": args.profile,
+               "cacheSize": args.cache, "persistCache": args.persist_cache}
+    if args.batch:
+        if args.batch == "-":
+            solveBatch(paths, args.backend, sys.stdin, args.jobs, **options)
+        else:
+            with open(args.batch) as puzzlesIn:
+                solveBatch(paths, args.backend, puzzlesIn, args.jobs,
+                           **options)
+        return
+    if args.serve:
+        with suppress(KeyboardInterrupt):
+            asyncio.run(serve(paths, args.backend, args.serve, args.jobs,
+                              **options))
+        return
     histfile = Path.home() / ".wssolve_history"
     try:
         readline.read_history_file(histfile)
@@ -641,17 +1357,213 @@ def main():
 
     cryptogram = cleanInput("Enter the cryptogram:    ")
     known      = cleanInput("Enter any known letters: ")
-    with closing(Catalog(path)) as cat:
-        solver = Solver(cat, cryptogram, known)
+    with ExitStack() as stack:
+        cats = [stack.enter_context(closing(cat))
+                for cat in openCatalogs(paths, args.backend, args.cache,
+                                        args.persist_cache)]
+        profile = Profile() if args.profile else None
+        solver = Solver(cats, cryptogram, known, args.numpy, profile)
+        # the largest catalog has the most representative quadgrams, they
+        # are only loaded if some word needs them, and then kept
+        quadgrams = lazyQuadgrams(cats[-1])
         tictocDo(solver.solve, "solver.solve")
+        printSolve(solver, quadgrams, args)
+        # more known letters refine the solve rather than starting again
+        while True:
+            try:
+                known = cleanInput("Enter more known letters, like gur=the, "
+                                   "or return to finish: ")
+            except EOFError:
+                break
+            if not known.strip():
+                break
+            tictocDo(solver.addKnown, "solver.addKnown", known)
+            printSolve(solver, quadgrams, args)
+        if profile:
+            print(json.dumps(profile.asdict()))
+        if args.cache:
+            for path, cat in zip(paths, cats):
+                if not getattr(cat, "opened", True):
+                    continue
+                print("Catalog {} cache {hits} hits, {misses} misses, "
+                      "{size} queries".format(path, **cat.stats()))
+
+def printSolve(solver, quadgrams, args):
+    "quadgrams is a function giving the Quadgrams to climb with, or None"
+    if args.solutions:
+        print(solver.cipher)
+        print(solver.crypted)
+        solver._printProduct(args.solutions)
+    elif args.best:
+        print(solver.cipher)
+        print(solver.crypted)
+        solver._printBest(args.best)
+    else:
         solver.print()
+    if any(word.unsolvable for word in solver.words):
+        if quadgrams():
+            score, key = tictocDo(solver.climb, "solver.climb", quadgrams())
+            print("Some words are not in the catalog, by quadgrams it "
+                  "could be")
+            print(solver.decryptWith(key))
 
 def cleanInput(prompt):
-    text = input(prompt)
+    return cleanText(input(prompt))
+
+def cleanText(text):
     text = text.lower()
     text = text.replace("’", "'")
     return text
 
+#---------------------------------------------------------------------------
+# Batch solving.  Each line of the input is either a JSON object like
+#   {"id": 7, "cryptogram": "gur yvggyr xvggra", "known": "g=t"}
+# or a cryptogram, optionally followed by a tab and the known letters.
+# Each puzzle gives one JSON line of output, in the same order.
+def solveBatch(paths, backend, puzzlesIn, jobs=1, **options):
+    "options are those of openWorkerCatalog"
+    puzzles = (parsePuzzle(n, line)
+               for n, line in enumerate(puzzlesIn, 1) if line.strip())
+    if jobs > 1:
+        with ProcessPoolExecutor(jobs, initializer=partial(openWorkerCatalog,
+                                                           paths, backend,
+                                                           **options)) as pool:
+            for result in pool.map(solvePuzzle, puzzles, chunksize=4):
+                print(json.dumps(result), flush=True)
+    else:
+        openWorkerCatalog(paths, backend, **options)
+        for result in map(solvePuzzle, puzzles):
+            print(json.dumps(result), flush=True)
+
+def parsePuzzle(n, line):
+    line = line.rstrip("\r\n")
+    if line.lstrip().startswith("{"):
+        try:
+            puzzle = json.loads(line)
+        except ValueError as exc:
+            return {"id": n, "error": "bad puzzle: {}".format(exc)}
+    else:
+        cryptogram, _, known = line.partition("\t")
+        puzzle = {"cryptogram": cryptogram, "known": known}
+    puzzle.setdefault("id", n)
+    puzzle.setdefault("known", "")
+    return puzzle
+
+workerCatalogs  = []
+workerQuadgrams = lambda: None
+workerUseNumpy  = False
+workerProfile   = False
+
+def openWorkerCatalog(paths, backend, useNumpy=False, profile=False,
+                      cacheSize=0, persistCache=False):
+    """
+    open the catalogs, smallest first, once for all the puzzles this
+    process will solve.  paths can also be a single path.
+    """
+    global workerCatalogs, workerQuadgrams, workerUseNumpy, workerProfile
+    workerCatalogs  = openCatalogs(paths, backend, cacheSize, persistCache)
+    # loaded once, and the scores worked out the first time they are used,
+    # rather than for every puzzle with a word that isn't in the catalogs.
+    # The largest catalog has the most representative quadgrams.
+    workerQuadgrams = lazyQuadgrams(workerCatalogs[-1])
+    workerUseNumpy  = useNumpy
+    workerProfile   = profile
+    # a pool's workers don't run atexit, but do run multiprocessing's
+    # finalizers, which closes (and so saves the cache of) each catalog
+    for catalog in workerCatalogs:
+        Finalize(catalog, catalog.close, exitpriority=10)
+
+def catalogPaths(paths):
+    "a list of catalog paths, given a list or a single path"
+    if isinstance(paths, (str, os.PathLike)):
+        return [paths]
+    return list(paths)
+
+def solvePuzzle(puzzle):
+    if "error" in puzzle:
+        return puzzle
+    result = {"id": puzzle["id"], "cryptogram": puzzle.get("cryptogram")}
+    try:
+        # the solver's progress messages would get mixed into the results
+        # a puzzle can ask to be profiled even if the batch isn't
+        profile = (Profile() if workerProfile or puzzle.get("profile")
+                   else None)
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            solver = Solver(workerCatalogs, cleanText(puzzle["cryptogram"]),
+                            cleanText(puzzle["known"]), workerUseNumpy,
+                            profile)
+            solver.solve()
+        result["decrypted"] = solver.decrypt()
+        result["solved"]    = solver.cipher.solved
+        if any(word.unsolvable for word in solver.words):
+            quadgrams = workerQuadgrams()
+            if quadgrams:
+                score, key = solver._timeDo(
+                    lambda: solver.climb(quadgrams), "climb")
+                result["climbed"] = solver.decryptWith(key)
+        result["timings"]   = solver.timings
+        if profile:
+            result["profile"] = profile.asdict()
+            stats = [catalog.stats() for catalog in workerCatalogs
+                     if getattr(catalog, "opened", True) and
+                        hasattr(catalog, "stats")]
+            if stats:
+                # so far, for all the puzzles this process has solved, and
+                # added up over the catalogs
+                result["profile"]["cache"] = dict(sum(map(Counter, stats),
+                                                      Counter()))
+    except Exception as exc:
+        result["error"] = "{}: {}".format(type(exc).__name__, exc)
+    return result
+
+#---------------------------------------------------------------------------
+# The solver service.  A client sends puzzles as lines, in the same format
+# as a batch, and gets back a JSON result line for each one.  Connections
+# are handled concurrently, and the puzzles solved by a pool of processes
+# that each keep the catalog open.
+async def serve(paths, backend, address, jobs=1, **options):
+    "options are those of openWorkerCatalog"
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(jobs, initializer=partial(openWorkerCatalog,
+                                                       paths, backend,
+                                                       **options)) as pool:
+        # start the workers now, so no request waits for the catalog
+        await asyncio.gather(*(loop.run_in_executor(pool, os.getpid)
+                               for n in range(jobs)))
+
+        async def handleClient(reader, writer):
+            n = 0
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                n += 1
+                puzzle = parsePuzzle(n, line.decode(errors="replace"))
+                result = await loop.run_in_executor(pool, solvePuzzle, puzzle)
+                writer.write(json.dumps(result).encode() + b"\n")
+                await writer.drain()
+            writer.close()
+
+        address = parseAddress(address)
+        if isinstance(address, tuple):
+            server = await asyncio.start_server(handleClient, *address)
+        else:
+            with suppress(FileNotFoundError):
+                os.unlink(address)
+            server = await asyncio.start_unix_server(handleClient, address)
+        print("Serving {} on {}"
+              .format(", ".join(map(str, catalogPaths(paths))), address),
+              flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if not isinstance(address, tuple):
+                with suppress(FileNotFoundError):
+                    os.unlink(address)
+
 def saveHistory(prev_h_len, histfile):
     new_h_len = readline.get_current_history_length()
     readline.set_history_length(1000)
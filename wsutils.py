@@ -3,10 +3,105 @@
 #---------------------------------------------------------------------------
 
 import sys
-from collections import Counter
-from io import StringIO
+import os
+import json
+import queue
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from array import array
+from functools import lru_cache
+from itertools import islice
+from math import log10
 from pathlib import Path
+import mmap
+import re
 import sqlite3
+import struct
+
+#---------------------------------------------------------------------------
+ALL_LETTERS = 0x3ffffff
+
+try:
+    bitCount = int.bit_count
+except AttributeError:
+    def bitCount(v):
+        return bin(v).count("1")
+
+# a cipher can reach any of 2**26 masks, so the caches are bounded, but a
+# solve only meets a few hundred
+MASK_CACHE_SIZE = 4096
+
+@lru_cache(maxsize=MASK_CACHE_SIZE)
+def maskLetters(mask):
+    "the (lowercase) letters in a bitmask, in order"
+    return "".join(chr(0x61 + x) for x in range(26) if 1 << x & mask)
+
+@lru_cache(maxsize=MASK_CACHE_SIZE)
+def maskGlob(mask):
+    "the glob for a bitmask of possible (lowercase) letters"
+    if mask == ALL_LETTERS:
+        return "?"
+    letters = maskLetters(mask)
+    if len(letters) > 1:
+        letters = "[{}]".format(letters)
+    return letters
+
+@lru_cache(maxsize=MASK_CACHE_SIZE)
+def maskTable(mask):
+    "a bytes.translate table of the letters in a bitmask to 1, others to 0"
+    table = bytearray(b"0" * 256)
+    for letter in maskLetters(mask):
+        table[ord(letter)] = ord("1")
+    return bytes(table)
+
+def masksGlob(masks):
+    "the glob for a word, given a letter bitmask (or None) per position"
+    # the pattern already fixes any apostrophes, so None can be a ?
+    return "".join("?" if mask is None else maskGlob(mask) for mask in masks)
+
+def globMasks(glob):
+    "the letter bitmask (or None if unconstrained) per position of a glob"
+    masks = []
+    letters = None
+    for goo in glob:
+        if letters is not None:
+            if goo == ']':
+                masks.append(letters)
+                letters = None
+            else:
+                letters |= 1 << ord(goo) - 0x61
+        elif goo == '[':
+            letters = 0b0
+        elif 'a' <= goo <= 'z':
+            masks.append(1 << ord(goo) - 0x61)
+        else:
+            masks.append(None)
+    return tuple(masks)
+
+def globRegex(glob, flags=re.MULTILINE, binary=False):
+    "compile a catalog glob into a regex matching one word per line"
+    regex = "^{}$".format(glob.replace('?', '.'))
+    if binary:
+        regex = regex.encode()
+    return re.compile(regex, flags)
+
+class RegexGlobs:
+    """
+    Globs for a catalog that answers them with a regex over its words, each
+    compiled once into self.regexes.  BINARY if the words are bytes.
+    """
+    BINARY = False
+
+    def _glob(self, glob):
+        if isinstance(glob, str):
+            return glob
+        return masksGlob(glob)
+
+    def _regex(self, glob):
+        regex = self.regexes.get(glob)
+        if regex is None:
+            regex = self.regexes[glob] = globRegex(glob, binary=self.BINARY)
+        return regex
 
 #---------------------------------------------------------------------------
 class Pattern:
@@ -15,24 +110,24 @@ class Pattern:
 
     @classmethod
     def build(cls, word):
-        charCount = Counter(word)
         groupMap = {}
         nextGroup = '1'
-        buffer = StringIO()
+        chars = []
         for char in word:
             if not char.islower():
-                buffer.write(char)
-            elif charCount[char] <= 1:
-                buffer.write('_')
+                chars.append(char)
+            elif word.count(char) <= 1:
+                chars.append('_')
             else:
-                group = groupMap.setdefault(char, nextGroup)
-                if group == nextGroup:
+                group = groupMap.get(char)
+                if group is None:
+                    group = groupMap[char] = nextGroup
                     if nextGroup == '9':
                         nextGroup = 'A'
                     else:
                         nextGroup = chr(ord(nextGroup) + 1)
-                buffer.write(group)
-        return cls(buffer.getvalue())
+                chars.append(group)
+        return cls("".join(chars))
 
     def __str__(self):
         return self.patt
@@ -51,60 +146,842 @@ class Pattern:
         del groupCount['_']
         return list(groupCount.items())
 
+#---------------------------------------------------------------------------
+class Quadgrams:
+    """
+    How often each sequence of four symbols appears in the words of a
+    catalog, where the symbols are the letters and a space either side of a
+    word.  The counts are kept in a flat array indexed by the four symbols as
+    a base 27 number, and scores are the log10 of their probabilities in a
+    matching array, so scoring text is just array lookups.
+    """
+    SYMBOLS = 27
+    SPACE   = 26
+
+    def __init__(self, counts=None):
+        if counts is None:
+            counts = array("d", bytes(8 * self.SYMBOLS ** 4))
+        self.counts = counts
+        self._scores = None
+
+    @classmethod
+    def frombytes(cls, data):
+        counts = array("d")
+        counts.frombytes(data)
+        return cls(counts)
+
+    def tobytes(self):
+        return self.counts.tobytes()
+
+    def add(self, word, weight=1.0):
+        counts = self.counts
+        for index in self.indices(word):
+            counts[index] += weight
+        self._scores = None
+
+    def addCounts(self, counts):
+        "add a mapping of quadgram index to count, as from countRows"
+        total = self.counts
+        for index, count in counts.items():
+            total[index] += count
+        self._scores = None
+
+    def addEntries(self, entries):
+        for word, weight in entries:
+            self.add(word, weight)
+
+    @classmethod
+    def encode(cls, text):
+        "the symbol of each letter or space in the text, anything else dropped"
+        return [cls.SPACE if char == ' ' else ord(char) - 0x61
+                for char in text if char == ' ' or 'a' <= char <= 'z']
+
+    @classmethod
+    def indices(cls, word):
+        "the index of each quadgram of a word"
+        symbols = cls.encode(" {} ".format(word))
+        return [cls.index(symbols, i) for i in range(len(symbols) - 3)]
+
+    @staticmethod
+    def index(symbols, i):
+        return ((symbols[i] * 27 + symbols[i+1]) * 27 + symbols[i+2]) * 27 \
+               + symbols[i+3]
+
+    @property
+    def scores(self):
+        if self._scores is None:
+            total = sum(self.counts) or 1.0
+            floor = log10(0.01 / total)
+            self._scores = array("d", (log10(count / total) if count > 0
+                                       else floor
+                                       for count in self.counts))
+        return self._scores
+
+    def score(self, symbols):
+        "the log10 probability of a sequence of symbols"
+        scores = self.scores
+        return sum(scores[((symbols[i] * 27 + symbols[i+1]) * 27 +
+                           symbols[i+2]) * 27 + symbols[i+3]]
+                   for i in range(len(symbols) - 3))
+
 #---------------------------------------------------------------------------
 class Catalog:
+    # constant SQL, so that sqlite3 reuses its prepared statements
+    SELECTS = {
+        "count": ("select count(*) from words where pattern=?",
+                  "select count(*) from words where pattern=? and word glob ?"),
+        "word":  ("select word from words where pattern=?",
+                  "select word from words where pattern=? and word glob ?"),
+    }
+
+    STATS_COUNT = "select count from pattern_stats where pattern=?"
+
     def __init__(self, path):
         conn = sqlite3.connect(path, isolation_level="EXCLUSIVE")
         self.curs = conn.cursor()
+        self._checkPatternStats()
 
     @classmethod
     def create(cls, path):
         cat = Catalog(path)
+        # a catalog being built can just be built again if it goes wrong
+        cat.curs.execute("pragma journal_mode = off")
+        cat.curs.execute("pragma synchronous = off")
         cat._createDatabase()
         return cat
 
-    def add(self, word):
+    def add(self, word, weight=1.0):
         patt = Pattern.build(word)
         pattern = str(patt)
-        self.curs.execute("insert or ignore into words values (?, ?)",
-                          (word, pattern))
+        self._dropPatternStats()
+        self.curs.execute("insert or ignore into words values (?, ?, ?)",
+                          (word, pattern, weight))
+
+    def bulkAdd(self, words, batchSize=10000):
+        """
+        Add many words, or (word, weight) pairs, in batches, returning how
+        many were read.
+        """
+        rows = ((word, str(Pattern.build(word)), 1.0)
+                if isinstance(word, str) else
+                (word[0], str(Pattern.build(word[0])), word[1])
+                for word in words)
+        batches = iter(lambda: list(islice(rows, batchSize)), [])
+        return self.bulkInsert(batches)
+
+    def bulkInsert(self, batches):
+        """
+        Insert batches of (word, pattern, weight) rows, building the pattern
+        index once they are all in rather than on every insert.  Returns how
+        many rows were read.
+        """
+        self.curs.execute("drop index if exists idx_words_pattern")
+        self._dropPatternStats()
+        numRead = 0
+        for batch in batches:
+            self.curs.executemany("insert or ignore into words "
+                                  "values (?, ?, ?)", batch)
+            numRead += len(batch)
+        self._createIndex()
+        return numRead
 
+    # Incremental updates.  Each is one transaction that only touches the
+    # rows (and pattern index entries) of the words added or removed, and
+    # adds or takes away their quadgrams rather than counting them all again.
+    def appendRows(self, batches):
+        """
+        Add batches of (word, pattern, weight) rows for any words that are
+        not already in the catalog.  Returns how many were read and added.
+        """
+        numRead = numAdded = 0
+        with self._transaction() as changed:
+            for batch in batches:
+                numRead += len(batch)
+                rows = self._newRows(batch)
+                self.curs.executemany("insert into words values (?, ?, ?)",
+                                      rows)
+                changed(rows, 1)
+                numAdded += len(rows)
+        return numRead, numAdded
+
+    def removeWords(self, words):
+        "remove the words, returning how many were in the catalog"
+        numRemoved = 0
+        words = iter(words)
+        with self._transaction() as changed:
+            for batch in iter(lambda: list(islice(words, 500)), []):
+                qry = "select word, pattern, weight from words " \
+                      "where word in ({})".format(",".join("?" * len(batch)))
+                rows = self.curs.execute(qry, batch).fetchall()
+                self.curs.executemany("delete from words where word = ?",
+                                      ((row[0],) for row in rows))
+                changed(rows, -1)
+                numRemoved += len(rows)
+        return numRemoved
+
+    def merge(self, path, batchSize=10000):
+        """
+        Add the words of another SQLite catalog that are not already in this
+        one.  Returns how many were read and added.
+        """
+        self.curs.execute("attach database ? as other", (str(path),))
+        try:
+            # a catalog from before weights has all its words weighing 1.0
+            weight = "weight" if self._hasWeights("other") else "1.0"
+            other = self.curs.connection.execute("select word, pattern, {} "
+                                                 "from other.words "
+                                                 "order by rowid"
+                                                 .format(weight))
+            return self.appendRows(iter(lambda: other.fetchmany(batchSize),
+                                        []))
+        finally:
+            self.curs.execute("detach database other")
+
+    @contextmanager
+    def _transaction(self):
+        """
+        a transaction, giving a function to call with the (word, pattern,
+        weight) rows added (n=1) or removed (n=-1) within it, so that the
+        quadgrams and pattern stats can be brought up to date at the end
+        """
+        conn = self.curs.connection
+        if conn.in_transaction:
+            conn.commit()
+        self.curs.execute("begin exclusive")
+        try:
+            if not self._hasWeights():
+                # a catalog from before weights
+                self.curs.execute("alter table words add column "
+                                  "weight real not null default 1.0")
+            quadgrams = self.quadgrams()
+            updated = quadgrams if quadgrams is not None else Quadgrams()
+            stats = Counter()
+            def changed(rows, n):
+                for word, pattern, weight in rows:
+                    updated.add(word, n * weight)
+                    stats[pattern] += n
+            yield changed
+            if quadgrams is None:
+                # a catalog from before quadgrams, or an empty one
+                self.curs.execute("create table if not exists quadgrams ("
+                                  "counts blob not null)")
+                self.buildQuadgrams()
+            else:
+                self.curs.execute("update quadgrams set counts = ?",
+                                  (quadgrams.tobytes(),))
+            if self.hasPatternStats:
+                self._updatePatternStats(stats)
+            else:
+                self.buildPatternStats()
+        except BaseException:
+            conn.rollback()
+            self._checkPatternStats()
+            raise
+        conn.commit()
+
+    def _newRows(self, rows):
+        "the rows for words not in the catalog, and not earlier in rows"
+        found = set()
+        words = [row[0] for row in rows]
+        for n in range(0, len(words), 500):
+            batch = words[n:n+500]
+            qry = "select word from words where word in ({})" \
+                    .format(",".join("?" * len(batch)))
+            found.update(word for word, in self.curs.execute(qry, batch))
+        newRows = []
+        for row in rows:
+            if row[0] not in found:
+                found.add(row[0])
+                newRows.append(row)
+        return newRows
+
+    # glob is either a glob string or a tuple of letter bitmasks, see Word
     def count(self, pattern, glob):
-        rows = self._query("count(*)", pattern, glob)
+        if isinstance(glob, str):
+            unconstrained = all(goo == '?' for goo in glob)
+        else:
+            unconstrained = all(mask is None or mask == ALL_LETTERS
+                                for mask in glob)
+        if unconstrained and self.hasPatternStats:
+            return self.patternCount(pattern)
+        rows = self._query("count", pattern, glob)
         return rows[0][0]
 
+    def patternCount(self, pattern):
+        "the number of words with pattern, or None without pattern stats"
+        if not self.hasPatternStats:
+            return None
+        row = self.curs.execute(self.STATS_COUNT, (str(pattern),)).fetchone()
+        return row[0] if row else 0
+
     def words(self, pattern, glob):
         rows = self._query("word", pattern, glob)
         return [row[0] for row in rows]
 
     def _query(self, select, pattern, glob):
         pattern = str(pattern)
+        if not isinstance(glob, str):
+            glob = masksGlob(glob)
+        qryAll, qryGlob = self.SELECTS[select]
         if any(goo != '?' for goo in glob):
-            qry = "select {} from words where pattern=? and word glob ?" \
-                    .format(select)
-            args = (pattern, glob)
+            self.curs.execute(qryGlob, (pattern, glob))
         else:
-            qry = "select {} from words where pattern=? ".format(select)
-            args = (pattern,)
-        self.curs.execute(qry, args)
+            self.curs.execute(qryAll, (pattern,))
         rows = self.curs.fetchall()
         return rows
 
+    def buildQuadgrams(self):
+        "count the quadgrams of every word in the catalog and store them"
+        quadgrams = Quadgrams()
+        quadgrams.addEntries(self.curs.execute("select word, weight "
+                                               "from words"))
+        self.storeQuadgrams(quadgrams)
+        return quadgrams
+
+    def storeQuadgrams(self, quadgrams):
+        "store Quadgrams already counted for the words, as by wsbuild"
+        self.curs.execute("delete from quadgrams")
+        self.curs.execute("insert into quadgrams values (?)",
+                          (quadgrams.tobytes(),))
+
+    def buildPatternStats(self):
+        "count the words of each pattern and store them"
+        self._createPatternStats()
+        self.curs.execute("insert into pattern_stats select pattern, "
+                          "count(*) from words group by pattern")
+
+    def storePatternStats(self, counts):
+        "store a mapping of pattern to word count already made for the words"
+        self._createPatternStats()
+        self.curs.executemany("insert into pattern_stats values (?, ?)",
+                              ((pattern, count)
+                               for pattern, count in counts.items() if count))
+
+    def _createPatternStats(self):
+        # separate statements, as executescript would commit a transaction
+        self.curs.execute("drop table if exists pattern_stats")
+        self.curs.execute("create table pattern_stats ("
+                          "pattern text not null primary key, "
+                          "count integer not null)")
+        self.hasPatternStats = True
+
+    def _updatePatternStats(self, changes):
+        for pattern, n in changes.items():
+            self.curs.execute("insert or ignore into pattern_stats "
+                              "values (?, 0)", (pattern,))
+            self.curs.execute("update pattern_stats set count = count + ? "
+                              "where pattern=?", (n, pattern))
+        self.curs.execute("delete from pattern_stats where count <= 0")
+
+    def _checkPatternStats(self):
+        # stats are only kept while they match the words, see add()
+        row = self.curs.execute("select count(*) from sqlite_master where "
+                                "type='table' and name='pattern_stats'")
+        self.hasPatternStats = bool(row.fetchone()[0])
+
+    def _dropPatternStats(self):
+        if self.hasPatternStats:
+            self.curs.execute("drop table pattern_stats")
+            self.hasPatternStats = False
+
+    def quadgrams(self):
+        "the catalog's Quadgrams, or None if it does not have any"
+        try:
+            row = self.curs.execute("select counts from quadgrams").fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return Quadgrams.frombytes(row[0]) if row else None
+
+    def weights(self, words):
+        "a dict of the weight of each of the words, 1.0 if it has none"
+        weights = dict.fromkeys(words, 1.0)
+        if self._hasWeights():
+            words = list(weights)
+            for n in range(0, len(words), 500):
+                batch = words[n:n+500]
+                qry = "select word, weight from words where word in ({})" \
+                        .format(",".join("?" * len(batch)))
+                weights.update(self.curs.execute(qry, batch))
+        return weights
+
+    def _hasWeights(self, schema="main"):
+        columns = [row[1] for row in
+                   self.curs.execute("pragma {}.table_info(words)"
+                                     .format(schema))]
+        return "weight" in columns
+
     def close(self):
         conn = self.curs.connection
         if conn.in_transaction:
             conn.commit()
         conn.close()
 
+    def _wordsByPattern(self):
+        byPattern = {}
+        self.curs.execute("select word, pattern from words order by rowid")
+        for word, pattern in self.curs:
+            byPattern.setdefault(pattern, []).append(word)
+        return byPattern
+
     def _createDatabase(self):
         self.curs.executescript("""
             drop table if exists words;
             create table words (
               word        text not null primary key,
-              pattern     text not null
+              pattern     text not null,
+              weight      real not null default 1.0
             );
-            create index idx_words_pattern on words (pattern);
+            drop table if exists quadgrams;
+            create table quadgrams (
+              counts      blob not null
+            );
+            drop table if exists pattern_stats;
                           """)
+        self.hasPatternStats = False
+        self._createIndex()
+
+    def _createIndex(self):
+        self.curs.execute("create index if not exists idx_words_pattern "
+                          "on words (pattern)")
+
+#---------------------------------------------------------------------------
+class ReadOnlyCatalog(Catalog):
+    """
+    A SQLite catalog opened read-only, with its pages memory-mapped, so many
+    processes can share the file and still see it being updated.
+    """
+    MMAP_SIZE = 1 << 30
+    IMMUTABLE = False
+
+    def __init__(self, path):
+        uri = "{}?mode=ro".format(Path(path).resolve().as_uri())
+        if self.IMMUTABLE:
+            uri += "&immutable=1"
+        # a ConnectionPool hands connections between threads
+        conn = sqlite3.connect(uri, uri=True, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute("pragma mmap_size = {}".format(self.MMAP_SIZE))
+        self.curs = conn.cursor()
+        self._checkPatternStats()
+
+class ImmutableCatalog(ReadOnlyCatalog):
+    """
+    A read-only SQLite catalog that is also opened immutable, so no locks
+    are taken at all.  The file must not be changed while it is open, or
+    queries may return wrong results or fail.
+    """
+    IMMUTABLE = True
+
+class ConnectionPool:
+    """
+    Several read-only connections to one catalog, so that threads can query
+    it concurrently, each borrowing a connection for a query.
+    """
+    def __init__(self, path, size=4):
+        self.catalogs = [ReadOnlyCatalog(path) for n in range(size)]
+        self.idle = queue.Queue()
+        for catalog in self.catalogs:
+            self.idle.put(catalog)
+
+    @contextmanager
+    def catalog(self):
+        catalog = self.idle.get()
+        try:
+            yield catalog
+        finally:
+            self.idle.put(catalog)
+
+    def count(self, pattern, glob):
+        with self.catalog() as catalog:
+            return catalog.count(pattern, glob)
+
+    def words(self, pattern, glob):
+        with self.catalog() as catalog:
+            return catalog.words(pattern, glob)
+
+    def patternCount(self, pattern):
+        with self.catalog() as catalog:
+            return catalog.patternCount(pattern)
+
+    def quadgrams(self):
+        with self.catalog() as catalog:
+            return catalog.quadgrams()
+
+    def weights(self, words):
+        with self.catalog() as catalog:
+            return catalog.weights(words)
+
+    def close(self):
+        for catalog in self.catalogs:
+            catalog.close()
+
+#---------------------------------------------------------------------------
+class MemoryCatalog(RegexGlobs, ReadOnlyCatalog):
+    """
+    A read-only catalog loaded once into memory.  The words of each pattern
+    are kept in one newline separated string, and globs are answered by a
+    regex over that string, so no query goes back to SQLite.
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        self.index = {pattern: "".join(word + "\n" for word in words)
+                      for pattern, words in self._wordsByPattern().items()}
+        self.regexes = {}
+
+    def count(self, pattern, glob):
+        pattern = str(pattern)
+        glob  = self._glob(glob)
+        block = self.index.get(pattern, "")
+        if all(goo == '?' for goo in glob):
+            return block.count("\n")
+        return len(self._regex(glob).findall(block))
+
+    def words(self, pattern, glob):
+        pattern = str(pattern)
+        glob  = self._glob(glob)
+        block = self.index.get(pattern, "")
+        if all(goo == '?' for goo in glob):
+            return block.split("\n")[:-1]
+        return self._regex(glob).findall(block)
+
+#---------------------------------------------------------------------------
+class BitsetCatalog(ReadOnlyCatalog):
+    """
+    A read-only catalog loaded once into memory with, for each pattern, a
+    bitset of word ids per (position, letter).  Letter bitmasks are answered
+    by ORing together the bitsets of the letters allowed at each position and
+    ANDing the positions, without ever building a glob.
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        self.index = {}
+        for pattern, words in self._wordsByPattern().items():
+            positions = [[0b0] * 26 for char in pattern]
+            for n, word in enumerate(words):
+                bit = 1 << n
+                for letters, char in zip(positions, word):
+                    if 'a' <= char <= 'z':
+                        letters[ord(char) - 0x61] |= bit
+            self.index[pattern] = (tuple(words), positions)
+
+    def count(self, pattern, glob):
+        return bitCount(self._match(pattern, glob)[1])
+
+    def words(self, pattern, glob):
+        words, matches = self._match(pattern, glob)
+        if matches == (1 << len(words)) - 1:
+            return list(words)
+        # one pass over the bits, lowest (the first word) first
+        bits = bin(matches)[:1:-1]
+        return [word for word, bit in zip(words, bits) if bit == "1"]
+
+    def _match(self, pattern, glob):
+        entry = self.index.get(str(pattern))
+        if entry is None:
+            return (), 0b0
+        words, positions = entry
+        if isinstance(glob, str):
+            glob = globMasks(glob)
+        matches = (1 << len(words)) - 1
+        for letters, mask in zip(positions, glob):
+            if mask is None or mask == ALL_LETTERS:
+                continue
+            allowed = 0b0
+            if bitCount(mask) <= 13:
+                for x in range(26):
+                    if 1 << x & mask:
+                        allowed |= letters[x]
+            else:
+                # quicker to take away the few letters not allowed
+                allowed = matches
+                for x in range(26):
+                    if not 1 << x & mask:
+                        allowed &= ~letters[x]
+            matches &= allowed
+            if not matches:
+                break
+        return words, matches
+
+#---------------------------------------------------------------------------
+class BinaryCatalog(RegexGlobs):
+    """
+    A compact read-only catalog file that is memory-mapped rather than
+    queried.  After the header comes a table of (offset, count, first,
+    pattern) for each pattern, then every word as a fixed width newline
+    terminated record, sorted by pattern, then the weight of each record,
+    then the quadgram counts.
+    As all the words of a pattern are the same length, they can be counted
+    from the table and globbed by a regex run directly over their slice of
+    the map.
+    """
+    BINARY = True
+    MAGIC  = b"WSCAT\0\0\3"
+    HEADER = struct.Struct("<8sIQQ")
+    ENTRY  = struct.Struct("<QIIH")
+    WEIGHT = struct.Struct("<f")
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map  = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, numPatterns, self.weightsOffset, self.quadgramsOffset = \
+                self.HEADER.unpack_from(self.map)
+        if magic != self.MAGIC:
+            raise ValueError("{} is not a binary catalog".format(path))
+        self.index = {}
+        pos = self.HEADER.size
+        for n in range(numPatterns):
+            offset, count, first, size = self.ENTRY.unpack_from(self.map, pos)
+            pos += self.ENTRY.size
+            pattern = self.map[pos:pos+size].decode()
+            pos += size
+            self.index[pattern] = (offset, count, first)
+        self.regexes = {}
+        self.records = {}
+
+    @classmethod
+    def isBinary(cls, path):
+        with open(path, "rb") as catIn:
+            return catIn.read(len(cls.MAGIC)) == cls.MAGIC
+
+    @classmethod
+    def write(cls, path, batches, quadgrams=None):
+        """
+        Write batches of (word, pattern, weight) rows to a new binary
+        catalog, ignoring repeated words like insert or ignore.  The
+        Quadgrams of the words are counted unless given.  Returns how many
+        rows were read.
+        """
+        weights = {}
+        byPattern = {}
+        numRead = 0
+        for batch in batches:
+            numRead += len(batch)
+            for word, pattern, weight in batch:
+                if word not in weights:
+                    weights[word] = weight
+                    byPattern.setdefault(pattern, []).append(word)
+        patterns = sorted(byPattern)
+        tableSize = sum(cls.ENTRY.size + len(pattern) for pattern in patterns)
+        # the leading newline lets ^ match at the start of the first record
+        offset  = cls.HEADER.size + tableSize + 1
+        dataEnd = offset + sum(len(byPattern[pattern]) * (len(pattern) + 1)
+                               for pattern in patterns)
+        weightsOffset = dataEnd + -dataEnd % cls.WEIGHT.size
+        weightsEnd = weightsOffset + len(weights) * cls.WEIGHT.size
+        quadgramsOffset = weightsEnd + -weightsEnd % 8
+        if quadgrams is None:
+            quadgrams = Quadgrams()
+            quadgrams.addEntries(weights.items())
+        first = 0
+        with open(path, "wb") as catOut:
+            catOut.write(cls.HEADER.pack(cls.MAGIC, len(patterns),
+                                         weightsOffset, quadgramsOffset))
+            for pattern in patterns:
+                words = byPattern[pattern]
+                catOut.write(cls.ENTRY.pack(offset, len(words), first,
+                                            len(pattern)))
+                catOut.write(pattern.encode())
+                offset += len(words) * (len(pattern) + 1)
+                first  += len(words)
+            catOut.write(b"\n")
+            for pattern in patterns:
+                for word in byPattern[pattern]:
+                    catOut.write(word.encode() + b"\n")
+            catOut.write(b"\0" * (weightsOffset - dataEnd))
+            for pattern in patterns:
+                for word in byPattern[pattern]:
+                    catOut.write(cls.WEIGHT.pack(weights[word]))
+            catOut.write(b"\0" * (quadgramsOffset - weightsEnd))
+            catOut.write(quadgrams.tobytes())
+        return numRead
+
+    def count(self, pattern, glob):
+        pattern = str(pattern)
+        glob = self._glob(glob)
+        offset, count, first = self.index.get(pattern, (0, 0, 0))
+        if not count or all(goo == '?' for goo in glob):
+            return count
+        end = offset + count * (len(pattern) + 1)
+        return sum(1 for match in self._regex(glob).finditer(self.map,
+                                                             offset, end))
+
+    def words(self, pattern, glob):
+        pattern = str(pattern)
+        glob = self._glob(glob)
+        offset, count, first = self.index.get(pattern, (0, 0, 0))
+        if not count:
+            return []
+        end = offset + count * (len(pattern) + 1)
+        if all(goo == '?' for goo in glob):
+            return self.map[offset:end].decode().split("\n")[:-1]
+        return [match.group().decode()
+                for match in self._regex(glob).finditer(self.map, offset, end)]
+
+    def patternCount(self, pattern):
+        return self.index.get(str(pattern), (0, 0, 0))[1]
+
+    def weights(self, words):
+        "a dict of the weight of each of the words"
+        weights = {}
+        for word in words:
+            n = self._records(str(Pattern.build(word))).get(word)
+            if n is None:
+                weights[word] = 1.0
+            else:
+                weights[word], = self.WEIGHT.unpack_from(
+                                        self.map,
+                                        self.weightsOffset + n * self.WEIGHT.size)
+        return weights
+
+    def _records(self, pattern):
+        # the record number of each word of pattern, indexed the first time
+        # the pattern's weights are wanted
+        records = self.records.get(pattern)
+        if records is None:
+            offset, count, first = self.index.get(pattern, (0, 0, 0))
+            words = self.words(pattern, "?" * len(pattern)) if count else []
+            records = self.records[pattern] = {word: first + n
+                                               for n, word in enumerate(words)}
+        return records
+
+    def quadgrams(self):
+        "the catalog's Quadgrams"
+        size = 8 * Quadgrams.SYMBOLS ** 4
+        return Quadgrams.frombytes(self.map[self.quadgramsOffset:
+                                            self.quadgramsOffset + size])
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+#---------------------------------------------------------------------------
+class CachedCatalog:
+    """
+    A bounded LRU cache of the count and words queries made of a catalog,
+    keyed on (pattern, glob), with hit and miss counts.  With a cachePath the
+    cache is loaded from there, if it was saved for the same catalog file,
+    and saved there again on close.
+    """
+    def __init__(self, catalog, maxSize=10000, cachePath=None, path=None):
+        self.catalog   = catalog
+        self.maxSize   = maxSize
+        self.cachePath = cachePath
+        # the catalog file's size and mtime, so a rebuilt one is noticed
+        self.version   = None
+        if path is not None:
+            stat = os.stat(path)
+            self.version = [stat.st_size, stat.st_mtime_ns]
+        self.cache  = OrderedDict()
+        self.hits   = 0
+        self.misses = 0
+        if cachePath is not None:
+            self._load()
+
+    def count(self, pattern, glob):
+        key = self._key(pattern, glob)
+        value = self._get(key)
+        if value is None:
+            value = self.catalog.count(pattern, glob)
+            self._put(key, value)
+        return value if isinstance(value, int) else len(value)
+
+    def words(self, pattern, glob):
+        key = self._key(pattern, glob)
+        value = self._get(key)
+        if not isinstance(value, list):
+            if value is not None:
+                # only the count was cached
+                self.hits   -= 1
+                self.misses += 1
+            value = self.catalog.words(pattern, glob)
+            self._put(key, value)
+        return list(value)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self.cache)}
+
+    def close(self):
+        if self.cachePath is not None:
+            self._save()
+        self.catalog.close()
+
+    def __getattr__(self, name):
+        return getattr(self.catalog, name)
+
+    @staticmethod
+    def _key(pattern, glob):
+        if not isinstance(glob, str):
+            glob = masksGlob(glob)
+        return str(pattern), glob
+
+    def _get(self, key):
+        value = self.cache.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+        return value
+
+    def _put(self, key, value):
+        self.cache[key] = value
+        if len(self.cache) > self.maxSize:
+            self.cache.popitem(last=False)
+
+    def _load(self):
+        try:
+            with open(self.cachePath) as cacheIn:
+                saved = json.load(cacheIn)
+        except (FileNotFoundError, ValueError):
+            return
+        if saved.get("version") != self.version:
+            return
+        for pattern, glob, value in saved["entries"][-self.maxSize:]:
+            self.cache[pattern, glob] = value
+
+    def _save(self):
+        saved = {"version": self.version,
+                 "entries": [[pattern, glob, value] for (pattern, glob), value
+                             in self.cache.items()]}
+        # written aside and renamed, as several processes may save at once
+        tmpPath = "{}.{}".format(self.cachePath, os.getpid())
+        with open(tmpPath, "w") as cacheOut:
+            json.dump(saved, cacheOut)
+        os.replace(tmpPath, self.cachePath)
+
+#---------------------------------------------------------------------------
+BACKENDS = {
+    "sqlite": ReadOnlyCatalog,
+    "sqlite-immutable": ImmutableCatalog,
+    "memory": MemoryCatalog,
+    "bitset": BitsetCatalog,
+    "mmap":   BinaryCatalog,
+}
+
+def openCatalog(path, backend=None, cacheSize=0, persistCache=False):
+    """
+    open a catalog, by default as whichever kind of file it is, with an LRU
+    cache of cacheSize queries that is kept next to it if persistCache
+    """
+    if backend is None:
+        backend = "mmap" if BinaryCatalog.isBinary(path) else "sqlite"
+    catalog = BACKENDS[backend](path)
+    if cacheSize:
+        cachePath = "{}.cache".format(path) if persistCache else None
+        catalog = CachedCatalog(catalog, cacheSize, cachePath, path)
+    return catalog
+
+#---------------------------------------------------------------------------
+def parseAddress(address):
+    """
+    A solver service address is either [HOST:]PORT on localhost, or the
+    path of a Unix socket.  Returns (host, port) or the path.
+    """
+    host, _, port = address.rpartition(":")
+    if port.isdigit():
+        return (host or "localhost", int(port))
+    return address
 
 #---------------------------------------------------------------------------
 #---------------------------------------------------------------------------